@@ -0,0 +1,317 @@
+"""
+API benchmark.
+
+Seeds users through the bulk import, then drives the user endpoints
+with the target concurrency for the given duration and reports latency
+percentiles, throughput and database queries per request.
+
+    python -m benchmarks.api --url http://localhost:8080 --users 1000 --concurrency 50 --duration 30 \
+        --output results.json --baseline baseline.json
+
+Queries per request are read from /metrics, which is per worker process,
+so run the server with SERVER_WORKERS=1 to get them
+"""
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import platform
+
+import aiohttp
+
+
+# operation: weight
+DEFAULT_MIX = {
+    'login': 1,
+    'list': 4,
+    'detail': 10,
+    'patch': 3,
+    'delete': 1,
+}
+
+# operation: (route, method) labels of the server metrics
+ROUTES = {
+    'login': ('login', 'POST'),
+    'list': ('UserView', 'GET'),
+    'detail': ('UserDetailView', 'GET'),
+    'patch': ('UserDetailView', 'PATCH'),
+    'delete': ('UserDetailView', 'DELETE'),
+}
+
+PASSWORD = 'bench'
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='User API benchmark')
+    parser.add_argument('--url', default='http://localhost:8080')
+    parser.add_argument('--admin-login', default='admin')
+    parser.add_argument('--admin-password', default='admin')
+    parser.add_argument('--users', type=int, default=1000, help='users to seed')
+    parser.add_argument('--concurrency', type=int, default=50)
+    parser.add_argument('--duration', type=float, default=30, help='seconds')
+    parser.add_argument('--mix', default=','.join(f'{op}={weight}' for op, weight in DEFAULT_MIX.items()),
+                        help='operation weights, e.g. detail=10,list=4')
+    parser.add_argument('--seed', type=int, default=0, help='random seed')
+    parser.add_argument('--output', help='JSON results file')
+    parser.add_argument('--baseline', help='JSON results of a previous run to compare with')
+    parser.add_argument('--max-regression', type=float, default=None,
+                        help='fail if p95 latency or throughput is worse than the baseline by this share, e.g. 0.1')
+    return parser.parse_args(argv)
+
+
+def parse_mix(mix):
+    ret = {}
+    for item in mix.split(','):
+        op, _, weight = item.partition('=')
+        if op not in ROUTES:
+            raise SystemExit(f'Unknown operation: {op}')
+        ret[op] = float(weight)
+    return ret
+
+
+def percentile(values, share):
+    """
+    Nearest-rank percentile of the sorted values
+    """
+    if not values:
+        return None
+    index = max(int(round(share * len(values) + 0.5)) - 1, 0)
+    return values[min(index, len(values) - 1)]
+
+
+def parse_query_metrics(text):
+    """
+    Sum and count of http_request_queries by (route, method)
+    """
+    ret = {}
+    for line in text.splitlines():
+        for suffix in ('sum', 'count'):
+            prefix = f'http_request_queries_{suffix}{{'
+            if not line.startswith(prefix):
+                continue
+            labels, _, value = line[len(prefix):].rpartition('} ')
+            labels = dict(item.split('=', 1) for item in labels.split(','))
+            key = (labels['route'].strip('"'), labels['method'].strip('"'))
+            ret.setdefault(key, {'sum': 0.0, 'count': 0.0})[suffix] = float(value)
+    return ret
+
+
+class Benchmark:
+    """
+    Closed-loop load generator: each of the concurrency workers
+    sends the next request when the previous one is answered
+    """
+
+    def __init__(self, args):
+        self.args = args
+        self.mix = parse_mix(args.mix)
+        self.random = random.Random(args.seed)
+        self.prefix = f'bench{int(time.time())}_'
+        self.latency = {op: [] for op in self.mix}
+        self.errors = {op: 0 for op in self.mix}
+        self.deletable = []
+        self.users = []
+
+    async def run(self):
+        async with aiohttp.ClientSession(self.args.url) as admin, \
+                aiohttp.ClientSession(self.args.url, cookie_jar=aiohttp.DummyCookieJar()) as anonymous:
+            await self.login(admin, self.args.admin_login, self.args.admin_password)
+            await self.seed(admin)
+
+            queries_before = await self.query_metrics(admin)
+            started = time.perf_counter()
+            deadline = started + self.args.duration
+            await asyncio.gather(*(self.worker(admin, anonymous, deadline) for _ in range(self.args.concurrency)))
+            elapsed = time.perf_counter() - started
+            queries_after = await self.query_metrics(admin)
+
+        return self.report(elapsed, queries_before, queries_after)
+
+    async def login(self, session, login, password):
+        async with session.post('/login', json={'login': login, 'password': password}) as resp:
+            if resp.status != 200:
+                raise SystemExit(f'Login failed: {resp.status} {await resp.text()}')
+
+    async def seed(self, session):
+        """
+        Importing the users, 1/10 of them are reserved for deletion
+        """
+        logins = [f'{self.prefix}{i}' for i in range(self.args.users)]
+        body = ''.join(json.dumps({
+            'name': f'name{i}',
+            'surname': f'surname{i}',
+            'login': login,
+            'password': PASSWORD,
+            'date_of_birth': f'{1950 + i % 60}-{1 + i % 12:02}-{1 + i % 28:02}',
+            'permissions': 'read',
+        }) + '\n' for i, login in enumerate(logins))
+
+        started = time.perf_counter()
+        async with session.post('/import/user', data=body, headers={'Content-Type': 'application/x-ndjson'}) as resp:
+            report = await resp.json()
+        if resp.status != 200 or report['errors']:
+            raise SystemExit(f'Seeding failed: {resp.status} {report}')
+        print(f'Seeded {report["created"]} users in {time.perf_counter() - started:.1f}s', file=sys.stderr)
+
+        reserved = len(logins) // 10
+        self.deletable = logins[:reserved]
+        self.users = logins[reserved:]
+
+    async def query_metrics(self, session):
+        async with session.get('/metrics') as resp:
+            return parse_query_metrics(await resp.text())
+
+    async def worker(self, admin, anonymous, deadline):
+        ops, weights = list(self.mix), list(self.mix.values())
+        while time.perf_counter() < deadline:
+            op = self.random.choices(ops, weights)[0]
+            if op == 'delete' and not self.deletable:
+                op = 'detail'
+            request = self.request(op, admin, anonymous)
+            started = time.perf_counter()
+            try:
+                async with request as resp:
+                    await resp.read()
+                    ok = resp.status < 400
+            except aiohttp.ClientError:
+                ok = False
+            self.latency.setdefault(op, []).append(time.perf_counter() - started)
+            if not ok:
+                self.errors[op] = self.errors.get(op, 0) + 1
+
+    def request(self, op, admin, anonymous):
+        if op == 'login':
+            login = self.random.choice(self.users)
+            return anonymous.post('/login', json={'login': login, 'password': PASSWORD})
+        if op == 'list':
+            return admin.get('/user', params={'limit': 50})
+        if op == 'detail':
+            return admin.get(f'/user/{self.random.choice(self.users)}')
+        if op == 'patch':
+            return admin.patch(
+                f'/user/{self.random.choice(self.users)}',
+                json={'name': f'name{self.random.randrange(10 ** 6)}', 'permissions': 'read'},
+            )
+        return admin.delete(f'/user/{self.deletable.pop()}')
+
+    def report(self, elapsed, queries_before, queries_after):
+        operations = {}
+        total = []
+        for op, latency in self.latency.items():
+            if not latency:
+                continue
+            latency.sort()
+            total.extend(latency)
+            operations[op] = summarize(latency, elapsed, self.errors.get(op, 0))
+            operations[op]['queries'] = queries_per_request(ROUTES[op], queries_before, queries_after)
+        total.sort()
+
+        return {
+            'config': {
+                'url': self.args.url,
+                'users': self.args.users,
+                'concurrency': self.args.concurrency,
+                'duration': self.args.duration,
+                'mix': self.mix,
+            },
+            'environment': {
+                'python': platform.python_version(),
+                'platform': platform.platform(),
+                'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            },
+            'elapsed': elapsed,
+            'operations': operations,
+            'total': summarize(total, elapsed, sum(self.errors.values())),
+        }
+
+
+def summarize(latency, elapsed, errors):
+    return {
+        'count': len(latency),
+        'errors': errors,
+        'throughput': len(latency) / elapsed if elapsed else 0.0,
+        'p50': percentile(latency, 0.50),
+        'p95': percentile(latency, 0.95),
+        'p99': percentile(latency, 0.99),
+    }
+
+
+def queries_per_request(key, before, after):
+    """
+    Average queries per request of the route between two metrics scrapes,
+    None if the server doesn't report them
+    """
+    if key not in after:
+        return None
+    start = before.get(key, {'sum': 0.0, 'count': 0.0})
+    count = after[key]['count'] - start['count']
+    if count <= 0:
+        return None
+    return (after[key]['sum'] - start['sum']) / count
+
+
+def compare(results, baseline, max_regression=None):
+    """
+    Printing the changes relative to the baseline, returns the list of regressions
+    """
+    regressions = []
+    print('\ncompared with the baseline:')
+    for op, current in {**results['operations'], 'total': results['total']}.items():
+        previous = baseline['total'] if op == 'total' else baseline['operations'].get(op)
+        if not previous:
+            continue
+        p95 = change(current['p95'], previous['p95'])
+        throughput = change(current['throughput'], previous['throughput'])
+        print(f'{op:>8}  p95 {format_change(p95)}  throughput {format_change(throughput)}')
+        if max_regression is not None and (
+            (p95 is not None and p95 > max_regression)
+            or (throughput is not None and -throughput > max_regression)
+        ):
+            regressions.append(op)
+    return regressions
+
+
+def change(current, previous):
+    if current is None or not previous:
+        return None
+    return current / previous - 1
+
+
+def format_change(value):
+    return '     n/a' if value is None else f'{value:+8.1%}'
+
+
+def print_results(results):
+    print(f'{"op":>8} {"count":>8} {"errors":>7} {"rps":>9} {"p50 ms":>8} {"p95 ms":>8} {"p99 ms":>8} {"queries":>8}')
+    for op, stats in {**results['operations'], 'total': results['total']}.items():
+        queries = stats.get('queries')
+        print(
+            f'{op:>8} {stats["count"]:>8} {stats["errors"]:>7} {stats["throughput"]:>9.1f} '
+            f'{stats["p50"] * 1000:>8.1f} {stats["p95"] * 1000:>8.1f} {stats["p99"] * 1000:>8.1f} '
+            f'{"n/a" if queries is None else f"{queries:.2f}":>8}'
+        )
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    results = asyncio.run(Benchmark(args).run())
+    print_results(results)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.max_regression)
+        if regressions:
+            print(f'\nregressions: {", ".join(regressions)}')
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,37 @@
+"""add permissions notify trigger
+
+Revision ID: 157682fc8dfc
+Revises: a2e5fed3567c
+Create Date: 2026-10-17 22:26:36.408161
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '157682fc8dfc'
+down_revision = 'a2e5fed3567c'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.execute("""
+        CREATE FUNCTION notify_permissions_changed() RETURNS trigger AS $$
+        BEGIN
+            PERFORM pg_notify('permissions_changed', TG_OP);
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql
+    """)
+    op.execute("""
+        CREATE TRIGGER permissions_changed
+        AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON permissions
+        FOR EACH STATEMENT EXECUTE FUNCTION notify_permissions_changed()
+    """)
+
+
+def downgrade() -> None:
+    op.execute('DROP TRIGGER permissions_changed ON permissions')
+    op.execute('DROP FUNCTION notify_permissions_changed()')
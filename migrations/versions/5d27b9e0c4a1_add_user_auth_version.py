@@ -0,0 +1,24 @@
+"""add user auth_version
+
+Revision ID: 5d27b9e0c4a1
+Revises: c81d4e2f6a90
+Create Date: 2026-10-17 23:58:12.204519
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5d27b9e0c4a1'
+down_revision = 'c81d4e2f6a90'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.add_column('user', sa.Column('auth_version', sa.Integer(), server_default='0', nullable=False))
+
+
+def downgrade() -> None:
+    op.drop_column('user', 'auth_version')
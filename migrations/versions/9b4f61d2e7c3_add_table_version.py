@@ -0,0 +1,54 @@
+"""add table version
+
+Revision ID: 9b4f61d2e7c3
+Revises: 5d27b9e0c4a1
+Create Date: 2026-10-18 00:21:47.918305
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '9b4f61d2e7c3'
+down_revision = '5d27b9e0c4a1'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.create_table(
+        'table_version',
+        sa.Column('name', sa.String(length=64), nullable=False),
+        sa.Column('version', sa.BigInteger(), server_default='0', nullable=False),
+        sa.PrimaryKeyConstraint('name'),
+    )
+    op.execute("INSERT INTO table_version (name) VALUES ('user')")
+    # the version row is updated in the writing transaction,
+    # so readers see the new version together with the new rows
+    op.execute("""
+        CREATE FUNCTION bump_table_version() RETURNS trigger AS $$
+        BEGIN
+            UPDATE table_version SET version = version + 1 WHERE name = TG_ARGV[0];
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql
+    """)
+    # the user list shows permission names, so permissions changes bump it too
+    op.execute("""
+        CREATE TRIGGER user_version
+        AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON "user"
+        FOR EACH STATEMENT EXECUTE FUNCTION bump_table_version('user')
+    """)
+    op.execute("""
+        CREATE TRIGGER user_permissions_version
+        AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON permissions
+        FOR EACH STATEMENT EXECUTE FUNCTION bump_table_version('user')
+    """)
+
+
+def downgrade() -> None:
+    op.execute('DROP TRIGGER user_permissions_version ON permissions')
+    op.execute('DROP TRIGGER user_version ON "user"')
+    op.execute('DROP FUNCTION bump_table_version()')
+    op.drop_table('table_version')
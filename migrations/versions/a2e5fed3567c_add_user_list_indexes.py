@@ -0,0 +1,30 @@
+"""add user list indexes
+
+Revision ID: a2e5fed3567c
+Revises: 4a3f78e7ba9f
+Create Date: 2026-10-17 22:20:21.335079
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a2e5fed3567c'
+down_revision = '4a3f78e7ba9f'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.create_index('ix_user_permissions_id', 'user', ['permissions', 'id'])
+    op.create_index('ix_user_date_of_birth', 'user', ['date_of_birth'])
+    op.create_index(
+        'ix_user_login_pattern', 'user', ['login'], postgresql_ops={'login': 'varchar_pattern_ops'}
+    )
+
+
+def downgrade() -> None:
+    op.drop_index('ix_user_login_pattern', table_name='user')
+    op.drop_index('ix_user_date_of_birth', table_name='user')
+    op.drop_index('ix_user_permissions_id', table_name='user')
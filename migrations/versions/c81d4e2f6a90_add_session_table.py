@@ -0,0 +1,34 @@
+"""add session table
+
+Revision ID: c81d4e2f6a90
+Revises: 157682fc8dfc
+Create Date: 2026-10-17 23:41:08.512734
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+# revision identifiers, used by Alembic.
+revision = 'c81d4e2f6a90'
+down_revision = '157682fc8dfc'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.create_table(
+        'session',
+        sa.Column('key', sa.String(length=64), nullable=False),
+        sa.Column('data', postgresql.JSONB(astext_type=sa.Text()), nullable=False),
+        sa.Column('expires', sa.DateTime(timezone=True), nullable=False),
+        sa.PrimaryKeyConstraint('key'),
+        prefixes=['UNLOGGED'],
+    )
+    op.create_index('ix_session_expires', 'session', ['expires'])
+
+
+def downgrade() -> None:
+    op.drop_index('ix_session_expires', table_name='session')
+    op.drop_table('session')
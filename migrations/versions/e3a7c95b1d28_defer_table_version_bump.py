@@ -0,0 +1,68 @@
+"""defer table version bump
+
+Revision ID: e3a7c95b1d28
+Revises: 9b4f61d2e7c3
+Create Date: 2026-10-18 02:05:13.402917
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e3a7c95b1d28'
+down_revision = '9b4f61d2e7c3'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.execute('DROP TRIGGER user_permissions_version ON permissions')
+    op.execute('DROP TRIGGER user_version ON "user"')
+    # the version row is updated once per transaction, at commit by the deferred triggers,
+    # so its lock isn't held while the transaction writes and doesn't serialize writers
+    op.execute("""
+        CREATE OR REPLACE FUNCTION bump_table_version() RETURNS trigger AS $$
+        DECLARE
+            bumped text := 'table_version.' || TG_ARGV[0];
+        BEGIN
+            IF current_setting(bumped, true) IS DISTINCT FROM 'on' THEN
+                PERFORM set_config(bumped, 'on', true);
+                UPDATE table_version SET version = version + 1 WHERE name = TG_ARGV[0];
+            END IF;
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql
+    """)
+    # constraint triggers are row triggers without TRUNCATE, it keeps a statement trigger
+    for table, trigger in (('"user"', 'user_version'), ('permissions', 'user_permissions_version')):
+        op.execute(f"""
+            CREATE CONSTRAINT TRIGGER {trigger}
+            AFTER INSERT OR UPDATE OR DELETE ON {table}
+            DEFERRABLE INITIALLY DEFERRED
+            FOR EACH ROW EXECUTE FUNCTION bump_table_version('user')
+        """)
+        op.execute(f"""
+            CREATE TRIGGER {trigger}_truncate
+            AFTER TRUNCATE ON {table}
+            FOR EACH STATEMENT EXECUTE FUNCTION bump_table_version('user')
+        """)
+
+
+def downgrade() -> None:
+    for table, trigger in (('"user"', 'user_version'), ('permissions', 'user_permissions_version')):
+        op.execute(f'DROP TRIGGER {trigger}_truncate ON {table}')
+        op.execute(f'DROP TRIGGER {trigger} ON {table}')
+        op.execute(f"""
+            CREATE TRIGGER {trigger}
+            AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON {table}
+            FOR EACH STATEMENT EXECUTE FUNCTION bump_table_version('user')
+        """)
+    op.execute("""
+        CREATE OR REPLACE FUNCTION bump_table_version() RETURNS trigger AS $$
+        BEGIN
+            UPDATE table_version SET version = version + 1 WHERE name = TG_ARGV[0];
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql
+    """)
@@ -0,0 +1,49 @@
+"""add user auth notify trigger
+
+Revision ID: f5c2a81d9e47
+Revises: e3a7c95b1d28
+Create Date: 2026-10-18 14:12:38.517204
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'f5c2a81d9e47'
+down_revision = 'e3a7c95b1d28'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    # notifications are delivered at commit, the workers invalidate their auth caches by login
+    op.execute("""
+        CREATE FUNCTION notify_user_auth_changed() RETURNS trigger AS $$
+        BEGIN
+            PERFORM pg_notify('user_auth_changed', OLD.login);
+            IF TG_OP = 'UPDATE' AND NEW.login <> OLD.login THEN
+                PERFORM pg_notify('user_auth_changed', NEW.login);
+            END IF;
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql
+    """)
+    op.execute("""
+        CREATE TRIGGER user_auth_changed
+        AFTER UPDATE ON "user"
+        FOR EACH ROW
+        WHEN (OLD.auth_version IS DISTINCT FROM NEW.auth_version OR OLD.login IS DISTINCT FROM NEW.login)
+        EXECUTE FUNCTION notify_user_auth_changed()
+    """)
+    op.execute("""
+        CREATE TRIGGER user_auth_deleted
+        AFTER DELETE ON "user"
+        FOR EACH ROW EXECUTE FUNCTION notify_user_auth_changed()
+    """)
+
+
+def downgrade() -> None:
+    op.execute('DROP TRIGGER user_auth_deleted ON "user"')
+    op.execute('DROP TRIGGER user_auth_changed ON "user"')
+    op.execute('DROP FUNCTION notify_user_auth_changed()')
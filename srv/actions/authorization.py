@@ -1,67 +1,98 @@
+from collections import namedtuple
+
+from aiohttp_security import SessionIdentityPolicy
 from aiohttp_security.abc import AbstractAuthorizationPolicy
+from aiohttp_session import get_session, new_session
+
+from .cache import TTLCache, MISSING
+
+
+# session key of the user id, permission and auth_version stored at login
+AUTH_KEY = 'AUTH'
+
+# identity of the authorized session
+AuthIdentity = namedtuple('AuthIdentity', ['login', 'id', 'permission', 'version'])
 
-import sqlalchemy as sa
-from passlib.hash import sha256_crypt
 
-from srv.store.pg import models
+def setup_auth_cache(app):
+    app['auth_cache'] = TTLCache(**app['config']['auth_cache'])
+
+
+class AuthSessionIdentityPolicy(SessionIdentityPolicy):
+    """
+    Session identity carrying the user id, permission and auth_version of the login time,
+    remember(request, response, login, auth=user_row) stores them.
+    Sessions without them aren't authorized.
+    Login starts a new session, the key of the previous one isn't reused
+    """
+
+    async def identify(self, request):
+        login = await super().identify(request)
+        if login is None:
+            return None
+        session = await get_session(request)
+        auth = session.get(AUTH_KEY)
+        if auth is None:
+            return None
+        return AuthIdentity(login, *auth)
+
+    async def remember(self, request, response, identity, auth=None, **kwargs):
+        session = await new_session(request)
+        await super().remember(request, response, identity, **kwargs)
+        session[AUTH_KEY] = [auth.id, auth.permissions, auth.auth_version]
+
+    async def forget(self, request, response):
+        await super().forget(request, response)
+        session = await get_session(request)
+        session.pop(AUTH_KEY, None)
 
 
 class DBAuthorizationPolicy(AbstractAuthorizationPolicy):
     """
-    Authorization policy for aiohttp_security
+    Authorization policy for aiohttp_security.
+
+    The permission comes from the session, the session is valid while the user's
+    auth_version is the same as at login. The user manager bumps it when the permission
+    changes, so blocked users lose access without reading their permission on every request
     """
 
-    def __init__(self, db):
+    def __init__(self, db, cache, users):
         self.db = db
+        self.cache = cache
+        self.users = users
 
     async def authorized_userid(self, identity):
-        async with self.db.connect() as conn:
-            ret = await conn.scalar(
-                sa.select(models.user.c.login, models.user.c.password, models.permissions.c.perm_name)
-                .where(
-                    sa.and_(
-                        models.user.c.permissions == models.permissions.c.id,
-                        models.user.c.login == identity,
-                        models.permissions.c.perm_name != 'block'
-                    )
-                )
-            )
-            if ret:
-                return identity
+        if await self._is_valid(identity):
+            return identity.login
 
     async def permits(self, identity, permission, context=None):
-        async with self.db.connect() as conn:
-            ret = await conn.execute(
-                sa.select(models.user.c.login, models.user.c.password, models.permissions.c.perm_name)
-                .where(
-                    sa.and_(
-                        models.user.c.permissions == models.permissions.c.id,
-                        models.user.c.login == identity,
-                        models.permissions.c.perm_name != 'block'
-                    )
-                )
-            )
-            user = ret.fetchone()
-            if user is not None:
-                perm = user[2]
-                if perm == permission:
-                    return True
-
-
-async def check_credentials(conn, data):
+        if identity is not None and identity.permission == permission:
+            return await self._is_valid(identity)
+        return False
+
+    async def _is_valid(self, identity):
+        """
+        Comparing the session auth_version with the current one, cached by login
+        """
+        version = self.cache.get(identity.login)
+        if version is MISSING:
+            generation = self.cache.generation
+            async with self.db.connect() as conn:
+                version = await self.users.get_auth_version(conn, identity.login)
+            self.cache.set(identity.login, version, generation)
+        return version is not None and version == (identity.id, identity.version)
+
+
+async def check_credentials(db, data, users):
+    """
+    Returns the user row of the id, permissions and auth_version if the password is valid.
+    The connection is released before the password is verified
+    """
     login = data['login']
     password = data['password']
 
-    hashed_password = await conn.scalar(
-            sa.select(models.user.c.password)
-            .where(
-                sa.and_(
-                    models.user.c.permissions == models.permissions.c.id,
-                    models.user.c.login == login,
-                    models.permissions.c.perm_name != 'block'
-                )
-            )
-        )
-
-    if hashed_password is not None:
-        return sha256_crypt.verify(password, hashed_password)
+    async with db.connect() as conn:
+        user = await users.get_credentials(conn, login)
+
+    if user is not None and await users.hasher.verify(password, user.password):
+        return user
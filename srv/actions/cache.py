@@ -0,0 +1,133 @@
+import time
+import asyncio
+from collections import OrderedDict
+
+
+MISSING = object()
+
+
+class TTLCache:
+    """
+    In-process LRU cache with expiring entries and hit/miss counters
+    """
+
+    def __init__(self, maxsize=1024, ttl=30):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.generation = 0
+        self._data = OrderedDict()
+
+    def get(self, key, default=MISSING):
+        item = self._data.get(key)
+        if item is not None:
+            value, expires = item
+            if expires > time.monotonic():
+                self._data.move_to_end(key)
+                self.hits += 1
+                return value
+            del self._data[key]
+        self.misses += 1
+        return default
+
+    def set(self, key, value, generation=None):
+        """
+        Storing the value.
+        Values loaded before the last invalidation (by generation) are discarded
+        """
+        if generation is not None and generation != self.generation:
+            return
+        self._data[key] = (value, time.monotonic() + self.ttl)
+        self._data.move_to_end(key)
+        if len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def items(self):
+        """
+        Unexpired (key, value) pairs, without counting hits
+        """
+        now = time.monotonic()
+        return [(key, value) for key, (value, expires) in self._data.items() if expires > now]
+
+    def invalidate(self, *keys):
+        self.generation += 1
+        for key in keys:
+            self._data.pop(key, None)
+
+    def clear(self):
+        self.generation += 1
+        self._data.clear()
+
+    def stats(self):
+        return {
+            'size': len(self._data),
+            'hits': self.hits,
+            'misses': self.misses,
+        }
+
+
+class SingleFlight:
+    """
+    Coalescing of concurrent calls: callers of a key in flight
+    wait for its result instead of calling again
+    """
+
+    def __init__(self):
+        self.calls = 0
+        self.coalesced = 0
+        self._flights = {}
+
+    async def do(self, key, func):
+        """
+        Result of func() shared with the concurrent calls of the key.
+        If the leading call is cancelled, the waiting callers call again
+        """
+        flight = self._flights.get(key)
+        if flight is not None:
+            self.coalesced += 1
+            try:
+                return await asyncio.shield(flight)
+            except asyncio.CancelledError:
+                if not flight.cancelled():
+                    raise
+                return await self.do(key, func)
+
+        self.calls += 1
+        flight = asyncio.get_running_loop().create_future()
+        self._flights[key] = flight
+        try:
+            result = await func()
+        except asyncio.CancelledError:
+            flight.cancel()
+            raise
+        except Exception as exc:
+            flight.set_exception(exc)
+            # retrieved, the leading caller raises it
+            flight.exception()
+            raise
+        else:
+            flight.set_result(result)
+            return result
+        finally:
+            if self._flights.get(key) is flight:
+                del self._flights[key]
+
+    def keys(self):
+        """
+        Keys of the calls in flight
+        """
+        return list(self._flights)
+
+    def forget(self, *keys):
+        """
+        Later calls of the keys don't join the calls in flight
+        """
+        for key in keys:
+            self._flights.pop(key, None)
+
+    def stats(self):
+        return {
+            'calls': self.calls,
+            'coalesced': self.coalesced,
+        }
@@ -0,0 +1,138 @@
+import os
+import time
+import asyncio
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from passlib.hash import sha256_crypt
+
+from srv.metrics import Histogram
+
+
+def setup_hasher(app):
+    hasher = PasswordHasher(**app['config']['hasher'])
+    app['hasher'] = hasher
+    app.on_startup.append(hasher.start)
+    app.on_cleanup.append(hasher.stop)
+
+
+def hash_password(password):
+    return sha256_crypt.using().hash(password)
+
+
+def verify_password(password, hashed_password):
+    return sha256_crypt.verify(password, hashed_password)
+
+
+def _timed_call(func, *args):
+    """
+    Runs in the executor, returns the start time to measure the queue wait
+    """
+    return time.monotonic(), func(*args)
+
+
+class HasherOverloaded(Exception):
+    """
+    The wait queue of the password hasher is full
+    """
+
+
+class PasswordHasher:
+    """
+    Password hashing and verification off the event loop.
+
+    At most max_concurrency calls are submitted to the executor at once,
+    the rest wait for a free slot. hash and verify raise HasherOverloaded
+    if max_queue calls are already waiting. hash_many of the bulk operations
+    has its own smaller share of max_bulk_concurrency slots and isn't limited
+    by the queue, so logins don't wait behind a whole import batch.
+    Until start() is called the default thread pool of the loop is used.
+    """
+
+    def __init__(
+        self, executor='process', max_workers=None, max_concurrency=None, max_queue=None, max_bulk_concurrency=None,
+    ):
+        self.executor_type = executor
+        self.max_workers = max_workers or os.cpu_count() or 1
+        self.max_concurrency = max_concurrency or self.max_workers * 4
+        self.max_queue = max_queue or self.max_concurrency * 16
+        self.max_bulk_concurrency = max_bulk_concurrency or max(self.max_workers // 2, 1)
+        self.executor = None
+        self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        self._bulk_semaphore = asyncio.Semaphore(self.max_bulk_concurrency)
+
+        self.calls = 0
+        self.pending = 0
+        self.waiting = 0
+        self.bulk_waiting = 0
+        self.rejected = 0
+        self.wait_time = 0.0
+        self.max_wait_time = 0.0
+        self.wait_histogram = Histogram()
+
+    async def start(self, app=None):
+        if self.executor_type == 'process':
+            self.executor = ProcessPoolExecutor(self.max_workers)
+        elif self.executor_type == 'thread':
+            self.executor = ThreadPoolExecutor(self.max_workers, thread_name_prefix='hasher')
+        else:
+            raise ValueError(f'Unknown hasher executor: {self.executor_type}')
+
+    async def stop(self, app=None):
+        if self.executor is not None:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+            self.executor = None
+
+    async def hash(self, password):
+        return await self._run(hash_password, password)
+
+    async def hash_many(self, passwords):
+        return await asyncio.gather(*(self._run(hash_password, password, bulk=True) for password in passwords))
+
+    async def verify(self, password, hashed_password):
+        return await self._run(verify_password, password, hashed_password)
+
+    async def _run(self, func, *args, bulk=False):
+        if not bulk and self._semaphore.locked() and self.waiting >= self.max_queue:
+            self.rejected += 1
+            raise HasherOverloaded()
+
+        loop = asyncio.get_running_loop()
+        queued = time.monotonic()
+        semaphore = self._bulk_semaphore if bulk else self._semaphore
+        self.pending += 1
+        try:
+            if bulk:
+                self.bulk_waiting += 1
+            else:
+                self.waiting += 1
+            try:
+                await semaphore.acquire()
+            finally:
+                if bulk:
+                    self.bulk_waiting -= 1
+                else:
+                    self.waiting -= 1
+            try:
+                started, result = await loop.run_in_executor(self.executor, _timed_call, func, *args)
+            finally:
+                semaphore.release()
+        finally:
+            self.pending -= 1
+
+        wait = max(started - queued, 0.0)
+        self.calls += 1
+        self.wait_time += wait
+        self.max_wait_time = max(self.max_wait_time, wait)
+        self.wait_histogram.observe(wait)
+        return result
+
+    def stats(self):
+        return {
+            'calls': self.calls,
+            'pending': self.pending,
+            'waiting': self.waiting,
+            'bulk_waiting': self.bulk_waiting,
+            'rejected': self.rejected,
+            'wait_time': self.wait_time,
+            'max_wait_time': self.max_wait_time,
+        }
@@ -1,22 +1,33 @@
 import sqlalchemy as sa
-from passlib.hash import sha256_crypt
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.schema import CreateTable
 
+from srv.store.base import BaseUserManager
+from .cache import SingleFlight
 from srv.store.pg import models
+from srv.store.pg.transaction import after_commit
 
 
 def setup_model_managers(app):
     app['model'] = {
-        'user': UserManager(),
+        'user': app['db_accessor'].create_user_manager(app),
     }
 
 
-class UserManager:
+class UserManager(BaseUserManager):
     """
     Managing user table operations
     """
     _model = models.user
     _sub_model = models.permissions
 
+    def __init__(self, auth_cache, hasher, permissions, read_cache=None):
+        super().__init__(auth_cache, hasher)
+        self.permissions = permissions
+        # concurrent reads of a slug share one query, found rows are cached if read_cache is set
+        self.read_cache = read_cache
+        self.read_flight = SingleFlight()
+
     @property
     def model(self):
         return self._model
@@ -29,90 +40,328 @@ class UserManager:
         await self._set_password(data)
         await self._set_permissions(conn, data)
 
-        user_id = await conn.scalar(
-            self.model.insert().values(data).returning(self.model.c.id)
+        ret = await conn.execute(
+            self._returning_users(self.model.insert().values(data))
         )
-        if user_id:
-            return await self._get_user_by_where(conn, self.model.c.id == user_id)
+        created_user = ret.fetchone()
+        if created_user:
+            after_commit(conn, lambda: self.auth_cache.invalidate(created_user.login))
+        return created_user
 
-    async def read(self, conn, slug):
-        where = await self._set_where(slug)
-        return await self._get_user_by_where(conn, where)
+    async def create_many(self, conn, data_list):
+        """
+        Batched create, returns the row views of created users in one statement
+        """
+        if not data_list:
+            return []
+        passwords = await self.hasher.hash_many(data['password'] for data in data_list)
+        for data, password in zip(data_list, passwords):
+            data['password'] = password
+            await self._set_permissions(conn, data)
 
-    async def read_all(self, conn):
+        # a multi-row insert needs the same keys in all rows, missing optional fields are null
+        columns = [column.name for column in self.model.c if any(column.name in data for data in data_list)]
         ret = await conn.execute(
-            sa.select(
-                self.model.c.id,
-                self.model.c.name,
-                self.model.c.surname,
-                self.model.c.login,
-                self.model.c.password,
-                self.model.c.date_of_birth,
-                self.sub_model.c.perm_name.label('permissions'),
-            ).where(self.model.c.permissions == self.sub_model.c.id)
+            self._returning_users(self.model.insert().values([
+                {column: data.get(column) for column in columns} for data in data_list
+            ]))
         )
-        return ret.fetchall()
+        created_users = ret.fetchall()
+        logins = [created_user.login for created_user in created_users]
+        after_commit(conn, lambda: self.auth_cache.invalidate(*logins))
+        return created_users
+
+    async def bulk_create(self, conn, rows):
+        """
+        Bulk insert of validated users: COPY into the staging table and merge.
+        rows is a list of (line number, user data) in line order.
+        Returns the number of created users and the list of (line number, errors) of rejected rows
+        """
+        staging = models.user_import
+        perm_ids = {}
+        for perm_name in {data.get('permissions', 'read') for _, data in rows}:
+            perm_ids[perm_name] = await self.permissions.get_id(conn, perm_name)
+
+        await conn.execute(CreateTable(staging, if_not_exists=True))
+        await conn.execute(sa.text(f'TRUNCATE {staging.name}'))
+        raw = await conn.get_raw_connection()
+        await raw.driver_connection.copy_records_to_table(
+            staging.name,
+            columns=[column.name for column in staging.c],
+            records=[
+                (
+                    line, data.get('name'), data.get('surname'), data['login'], data['password'],
+                    data.get('date_of_birth'), perm_ids.get(data.get('permissions', 'read')),
+                )
+                for line, data in rows
+            ],
+        )
+
+        # the first line wins for repeated logins
+        columns = ['name', 'surname', 'login', 'password', 'date_of_birth', 'permissions']
+        ret = await conn.execute(
+            insert(self.model).from_select(
+                columns,
+                sa.select(*(staging.c[name] for name in columns))
+                .distinct(staging.c.login)
+                .order_by(staging.c.login, staging.c.line)
+            )
+            .on_conflict_do_nothing(index_elements=[self.model.c.login])
+            .returning(self.model.c.login)
+        )
+        created = set(ret.scalars().all())
+        after_commit(conn, lambda: self.auth_cache.invalidate(*created))
+
+        errors, seen = [], set()
+        for line, data in rows:
+            if data['login'] in created and data['login'] not in seen:
+                seen.add(data['login'])
+            else:
+                errors.append((line, {'login': ['User with this login already exists']}))
+        return len(created), errors
+
+    async def read(self, conn, slug, fields=None):
+        """
+        Row by id or login, coalesced with the concurrent reads of the slug and fields
+        and cached by read_cache, update and delete invalidate it
+        """
+        key = (str(int(slug)) if slug.isdigit() else slug, fields)
+        if self.read_cache is None:
+            return await self.read_flight.do(key, lambda: self._read(conn, slug, fields))
+
+        row = self.read_cache.get(key, None)
+        if row is None:
+            generation = self.read_cache.generation
+            row = await self.read_flight.do(key, lambda: self._read(conn, slug, fields))
+            if row is not None:
+                self.read_cache.set(key, row, generation)
+        return row
+
+    def read_stats(self):
+        stats = self.read_flight.stats()
+        if self.read_cache is not None:
+            cache = self.read_cache.stats()
+            stats.update(cache_hits=cache['hits'], cache_misses=cache['misses'])
+        return stats
+
+    async def read_all(self, conn, limit=None, after=None, sort='id', fields=None, **filters):
+        """
+        Returns the page of filtered users and the keyset value of the next page.
+        sort is 'id' or 'login', '-' prefix for descending order
+        """
+        column = self.model.c[sort.lstrip('-')]
+        descending = sort.startswith('-')
+        if fields is not None:
+            fields = (*fields, column.name)
+
+        query = self._select_users(fields, **filters).order_by(column.desc() if descending else column)
+        if after is not None:
+            query = query.where(column < after if descending else column > after)
+        if limit:
+            query = query.limit(limit + 1)
+
+        ret = await conn.execute(query)
+        rows = ret.fetchall()
+        if limit and len(rows) > limit:
+            rows = rows[:limit]
+            return rows, rows[-1]._mapping[column.name]
+        return rows, None
+
+    async def stream_all(self, conn, batch_size=1000, **filters):
+        """
+        Yields batches of filtered users using a server-side cursor.
+        Requires a transaction, see SNAPSHOT mode
+        """
+        query = self._select_users(**filters).order_by(self.model.c.id)
+        async with conn.stream(query.execution_options(yield_per=batch_size)) as result:
+            async for rows in result.partitions(batch_size):
+                yield rows
 
     async def update(self, conn, slug, data):
         await self._set_password(data)
         await self._set_permissions(conn, data)
 
-        where = await self._set_where(slug)
-        user_id = await conn.scalar(
-            self.model.update().values(data).where(where).returning(self.model.c.id)
+        # join of the row before update to know the previous login
+        old = self.model.alias('old')
+        where = await self._set_where(slug, old)
+        values = {**data, 'auth_version': self._next_auth_version(data)}
+        ret = await conn.execute(
+            self._returning_users(
+                self.model.update().values(values).where(sa.and_(self.model.c.id == old.c.id, where)),
+                old.c.login.label('old_login'),
+            )
         )
-        if user_id:
-            return await self._get_user_by_where(conn, self.model.c.id == user_id)
+        updated_user = ret.fetchone()
+        if updated_user:
+            after_commit(conn, lambda: self.auth_cache.invalidate(updated_user.login, updated_user.old_login))
+            after_commit(
+                conn, lambda: self._invalidate_reads(str(updated_user.id), updated_user.login, updated_user.old_login)
+            )
+        return updated_user
 
     async def delete(self, conn, slug):
         where = await self._set_where(slug)
         ret = await conn.execute(
-            self.model.delete().where(where)
+            self.model.delete().where(where).returning(self.model.c.id, self.model.c.login)
+        )
+        deleted = ret.fetchall()
+        after_commit(conn, lambda: self.auth_cache.invalidate(*(row.login for row in deleted)))
+        slugs = [slug for row in deleted for slug in (str(row.id), row.login)]
+        after_commit(conn, lambda: self._invalidate_reads(*slugs))
+        return len(deleted)
+
+    async def read_version(self, conn, slug):
+        where = await self._set_where(slug)
+        ret = await conn.execute(
+            sa.select(self.model.c.id, self._row_version(self.model)).where(where)
+        )
+        row = ret.fetchone()
+        return tuple(row) if row else None
+
+    async def table_version(self, conn):
+        return await conn.scalar(
+            sa.select(models.table_version.c.version).where(models.table_version.c.name == self.model.name)
+        )
+
+    async def get_auth_version(self, conn, login):
+        ret = await conn.execute(
+            sa.select(self.model.c.id, self.model.c.auth_version).where(self.model.c.login == login)
+        )
+        row = ret.fetchone()
+        return tuple(row) if row else None
+
+    async def get_credentials(self, conn, login):
+        ret = await conn.execute(
+            sa.select(
+                self.model.c.id,
+                self.model.c.password,
+                self.sub_model.c.perm_name.label('permissions'),
+                self.model.c.auth_version,
+            ).where(self._unblocked_user(login))
         )
-        return ret.rowcount
+        return ret.fetchone()
 
-    async def _set_password(self, data):
+    def _next_auth_version(self, data):
         """
-        Password hashing
+        auth_version of the updated row, bumped if the permission changes
         """
-        if not data.get('password'):
-            return
-        data['password'] = sha256_crypt.using().hash(data['password'])
+        return sa.case(
+            (self.model.c.permissions.is_distinct_from(data['permissions']), self.model.c.auth_version + 1),
+            else_=self.model.c.auth_version,
+        )
+
+    async def _read(self, conn, slug, fields=None):
+        where = await self._set_where(slug)
+        return await self._get_user_by_where(conn, where, fields)
+
+    def _invalidate_reads(self, *slugs):
+        """
+        Invalidating the reads of the slugs with any fields
+        """
+        self.read_flight.forget(*(key for key in self.read_flight.keys() if key[0] in slugs))
+        if self.read_cache is not None:
+            self.read_cache.invalidate(*(key for key, _ in self.read_cache.items() if key[0] in slugs))
 
     async def _set_permissions(self, conn, user_data):
         """
         Setting permission id by permission name
         """
         perm_name = user_data.get('permissions', 'read')
-        perm_id = await conn.scalar(
-            sa.select(self.sub_model.c.id)
-            .where(self.sub_model.c.perm_name == perm_name)
-        )
-        user_data['permissions'] = perm_id
+        user_data['permissions'] = await self.permissions.get_id(conn, perm_name)
 
-    async def _get_user_by_where(self, conn, where):
+    async def _get_user_by_where(self, conn, where, fields=None):
         """
         Returns the row view of the user using the where query parameter
         """
         ret = await conn.execute(
-            sa.select(
-                self.model.c.id,
-                self.model.c.name,
-                self.model.c.surname,
-                self.model.c.login,
-                self.model.c.password,
-                self.model.c.date_of_birth,
-                self.sub_model.c.perm_name.label('permissions'),
-            ).where(sa.and_(self.model.c.permissions == self.sub_model.c.id, where))
+            self._select_users(fields).where(where)
         )
         row = ret.fetchone()
         return row
 
-    async def _set_where(self, slug):
+    def _select_users(
+            self, fields=None, permissions=None, date_of_birth_from=None, date_of_birth_to=None, login_prefix=None):
+        """
+        Select of the user row view with optional filters.
+        fields limits the columns, see _user_columns, the permissions are joined only if they are selected
+        """
+        query = sa.select(*self._user_columns(self.model, fields=fields))
+        if fields is None or 'permissions' in fields:
+            query = query.where(self.model.c.permissions == self.sub_model.c.id)
+        else:
+            # the rows of the join: permissions is a foreign key, it's null if the permission is deleted
+            query = query.where(self.model.c.permissions.is_not(None))
+
+        if permissions is not None:
+            # filter by the permission id to use the (permissions, id) index
+            query = query.where(
+                self.model.c.permissions == sa.select(self.sub_model.c.id)
+                .where(self.sub_model.c.perm_name == permissions)
+                .scalar_subquery()
+            )
+        if date_of_birth_from is not None:
+            query = query.where(self.model.c.date_of_birth >= date_of_birth_from)
+        if date_of_birth_to is not None:
+            query = query.where(self.model.c.date_of_birth <= date_of_birth_to)
+        if login_prefix is not None:
+            query = query.where(self.model.c.login.startswith(login_prefix, autoescape=True))
+        return query
+
+    def _returning_users(self, statement, *columns):
+        """
+        Select of the user row view over the rows returned by the insert/update statement,
+        so the change and the response row take one round trip
+        """
+        changed = statement.returning(
+            *self.model.c, self._row_version(self.model).label('version'), *columns
+        ).cte('changed')
+        return (
+            sa.select(*self._user_columns(changed, changed.c.version), *(changed.c[column.name] for column in columns))
+            .select_from(changed.join(self.sub_model, changed.c.permissions == self.sub_model.c.id))
+        )
+
+    def _user_columns(self, table, version=None, fields=None):
+        """
+        Columns of the user row view, only the id, version and fields if fields is set
+        """
+        version = self._row_version(table) if version is None else version
+        columns = [
+            table.c.id,
+            table.c.name,
+            table.c.surname,
+            table.c.login,
+            table.c.password,
+            table.c.date_of_birth,
+            self.sub_model.c.perm_name.label('permissions'),
+            version.label('version'),
+        ]
+        if fields is None:
+            return columns
+        return [column for column in columns if column.name in ('id', 'version', *fields)]
+
+    @staticmethod
+    def _row_version(table):
+        """
+        Row version: xmin, the id of the transaction that wrote the row
+        """
+        return sa.literal_column(f'"{table.name}".xmin', sa.BigInteger)
+
+    def _unblocked_user(self, login):
+        """
+        Where clause of the unblocked user by login, joins the permissions
+        """
+        return sa.and_(
+            self.model.c.permissions == self.sub_model.c.id,
+            self.model.c.login == login,
+            self.sub_model.c.perm_name != 'block',
+        )
+
+    async def _set_where(self, slug, model=None):
         """
         Setting 'sql: where' by id or login
         """
+        model = self.model if model is None else model
         if slug.isdigit():
-            return self.model.c.id == int(slug)
+            return model.c.id == int(slug)
         else:
-            return self.model.c.login == slug
+            return model.c.login == slug
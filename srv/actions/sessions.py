@@ -0,0 +1,93 @@
+import abc
+import copy
+import secrets
+
+from aiohttp_session import AbstractStorage, Session
+
+from .cache import TTLCache
+
+
+# session key of the aiohttp_security identity
+IDENTITY_KEY = 'AIOHTTP_SECURITY'
+
+
+class ServerSessionStorage(AbstractStorage):
+    """
+    Session data kept on the server, the cookie holds only an opaque random key.
+
+    Empty sessions aren't stored, saving an empty session (forget) deletes it.
+    Saving a new session replacing the one of the cookie (login) deletes the old key
+    """
+
+    def __init__(self, *, max_age=None, **kwargs):
+        super().__init__(max_age=max_age, **kwargs)
+
+    async def load_session(self, request):
+        key = self.load_cookie(request)
+        if key:
+            data = await self.load(key)
+            if data is not None:
+                return Session(key, data=data, new=False, max_age=self.max_age)
+        return Session(None, data=None, new=True, max_age=self.max_age)
+
+    async def save_session(self, request, response, session):
+        key = session.identity
+        if session.new:
+            old_key = self.load_cookie(request)
+            if old_key:
+                await self.delete(old_key)
+        if session.empty:
+            if key is not None:
+                await self.delete(key)
+            self.save_cookie(response, '', max_age=session.max_age)
+            return
+        if key is None:
+            key = secrets.token_urlsafe(32)
+        await self.save(key, self._get_session_data(session), session.max_age)
+        self.save_cookie(response, key, max_age=session.max_age)
+
+    @abc.abstractmethod
+    async def load(self, key):
+        """
+        Session data by the key, None if it doesn't exist or is expired
+        """
+
+    @abc.abstractmethod
+    async def save(self, key, data, max_age):
+        pass
+
+    @abc.abstractmethod
+    async def delete(self, key):
+        pass
+
+    @abc.abstractmethod
+    async def revoke(self, identity):
+        """
+        Forced logout: deleting all sessions of the identity (login),
+        returns the number of deleted sessions
+        """
+
+
+class MemorySessionStorage(ServerSessionStorage):
+    """
+    In-process LRU storage, sessions aren't shared between the workers
+    """
+
+    def __init__(self, maxsize=100_000, *, max_age=None, **kwargs):
+        super().__init__(max_age=max_age, **kwargs)
+        self.sessions = TTLCache(maxsize, ttl=max_age if max_age is not None else float('inf'))
+
+    async def load(self, key):
+        data = self.sessions.get(key, None)
+        return copy.deepcopy(data)
+
+    async def save(self, key, data, max_age):
+        self.sessions.set(key, copy.deepcopy(data))
+
+    async def delete(self, key):
+        self.sessions.invalidate(key)
+
+    async def revoke(self, identity):
+        keys = [key for key, data in self.sessions.items() if data['session'].get(IDENTITY_KEY) == identity]
+        self.sessions.invalidate(*keys)
+        return len(keys)
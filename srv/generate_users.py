@@ -0,0 +1,137 @@
+import string
+import random
+import asyncio
+import argparse
+import logging
+from datetime import date
+
+import sqlalchemy as sa
+
+from srv.actions.hashing import hash_password
+from srv.store.pg.models import user, permissions
+from srv.store.pg.options import create_db_engine, check_default_data
+from srv.settings.log import setup_logging
+
+
+logger = logging.getLogger(__name__)
+
+COLUMNS = ('name', 'surname', 'login', 'password', 'date_of_birth', 'permissions')
+DIGITS = string.digits + string.ascii_lowercase
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Synthetic users generator')
+    parser.add_argument('--count', type=int, default=1_000_000)
+    parser.add_argument('--batch-size', type=int, default=100_000, help='rows per COPY')
+    parser.add_argument('--permissions', default='read=90,admin=5,block=5', help='permission weights')
+    parser.add_argument('--login-length', default='6:16', help='min:max login length, uniform')
+    parser.add_argument('--birth-from', type=date.fromisoformat, default=date(1940, 1, 1))
+    parser.add_argument('--birth-to', type=date.fromisoformat, default=date(2010, 1, 1))
+    parser.add_argument('--password', default='password', help='password of all generated users')
+    parser.add_argument('--seed', type=int, default=None, help='random seed')
+    return parser.parse_args(argv)
+
+
+def parse_weights(value):
+    weights = {}
+    for item in value.split(','):
+        name, _, weight = item.partition('=')
+        weights[name] = float(weight)
+    return weights
+
+
+async def generate_users(
+        conn, count, batch_size=100_000, weights=None, login_length=(6, 16),
+        birth_range=(date(1940, 1, 1), date(2010, 1, 1)), password='password', seed=None):
+    """
+    Inserting count random users with COPY, returns the number of inserted rows.
+
+    Permissions are chosen by weights ({name: weight}), login lengths and birth dates
+    are uniform in the ranges. The password is hashed once and shared by all users.
+    Logins end with a base36 number after the current max id, so repeated runs don't collide
+    """
+    weights = weights or {'read': 90, 'admin': 5, 'block': 5}
+    ret = await conn.execute(
+        sa.select(permissions.c.perm_name, permissions.c.id).where(permissions.c.perm_name.in_(weights))
+    )
+    perm_ids = dict(ret.fetchall())
+    missing = set(weights) - set(perm_ids)
+    if missing:
+        raise ValueError(f'Unknown permissions: {", ".join(sorted(missing))}')
+
+    start = await conn.scalar(sa.select(sa.func.coalesce(sa.func.max(user.c.id), 0)))
+    records = user_records(
+        count, start, [perm_ids[name] for name in weights], list(weights.values()),
+        login_length, birth_range, hash_password(password), random.Random(seed),
+    )
+
+    raw = await conn.get_raw_connection()
+    inserted = 0
+    while inserted < count:
+        batch = [next(records) for _ in range(min(batch_size, count - inserted))]
+        await raw.driver_connection.copy_records_to_table(user.name, columns=COLUMNS, records=batch)
+        inserted += len(batch)
+        logger.info('Inserted %s of %s users', inserted, count)
+    await conn.execute(sa.text(f'ANALYZE "{user.name}"'))
+    return inserted
+
+
+def user_records(count, start, perm_ids, weights, login_length, birth_range, hashed_password, rnd):
+    """
+    Yields user rows in the COLUMNS order
+    """
+    min_length, max_length = login_length
+    first_day, last_day = birth_range[0].toordinal(), birth_range[1].toordinal()
+    # permissions for the whole run at once, choices is much faster in bulk
+    perms = iter(rnd.choices(perm_ids, weights, k=count))
+    for number in range(start + 1, start + count + 1):
+        suffix = to_base36(number)
+        length = max(rnd.randint(min_length, max_length) - len(suffix) - 1, 1)
+        yield (
+            random_name(rnd),
+            random_name(rnd),
+            f'{random_letters(rnd, length)}_{suffix}',
+            hashed_password,
+            date.fromordinal(rnd.randint(first_day, last_day)),
+            next(perms),
+        )
+
+
+def random_letters(rnd, length):
+    return ''.join(rnd.choices(string.ascii_lowercase, k=length))
+
+
+def random_name(rnd):
+    return random_letters(rnd, rnd.randint(3, 12)).capitalize()
+
+
+def to_base36(number):
+    ret = ''
+    while True:
+        number, digit = divmod(number, 36)
+        ret = DIGITS[digit] + ret
+        if not number:
+            return ret
+
+
+async def async_main(argv=None):
+    """
+    Generating users in the database from the config
+    """
+    args = parse_args(argv)
+    min_length, _, max_length = args.login_length.partition(':')
+    engine = await create_db_engine()
+    try:
+        async with engine.begin() as conn:
+            await check_default_data(conn)
+            await generate_users(
+                conn, args.count, args.batch_size, parse_weights(args.permissions),
+                (int(min_length), int(max_length)), (args.birth_from, args.birth_to), args.password, args.seed,
+            )
+    finally:
+        await engine.dispose()
+
+
+if __name__ == '__main__':
+    setup_logging()
+    asyncio.run(async_main())
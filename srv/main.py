@@ -1,11 +1,15 @@
-from aiohttp import web
-
-from srv.settings.app import create_app
+from srv.settings.config import CONFIG
+from srv.server import Supervisor, run_worker
 
 
 def main():
-    app = create_app()
-    web.run_app(app)
+    server = CONFIG['server']
+    if server['workers'] > 1:
+        Supervisor(**server).run()
+    else:
+        run_worker(
+            server['host'], server['port'], uvloop=server['uvloop'], shutdown_timeout=server['shutdown_timeout'],
+        )
 
 
 if __name__ == '__main__':
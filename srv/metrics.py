@@ -0,0 +1,207 @@
+import bisect
+
+from srv.settings.log import dropped_records
+
+
+# default latency buckets, seconds
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# queries per request buckets
+QUERY_BUCKETS = (0, 1, 2, 3, 5, 10, 25, 50, 100)
+
+
+class Histogram:
+    """
+    Histogram with fixed buckets.
+    Each observation increments one bucket counter, counts are made cumulative on export
+    """
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)  # the last one is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self):
+        """
+        Pairs of (upper bound, cumulative count), the last bound is +Inf
+        """
+        total, ret = 0, []
+        for bound, count in zip(self.buckets + (float('inf'),), self.counts):
+            total += count
+            ret.append((bound, total))
+        return ret
+
+    def snapshot(self):
+        return {
+            'buckets': {str(bound): count for bound, count in self.cumulative()},
+            'sum': self.sum,
+            'count': self.count,
+        }
+
+
+def setup_metrics(app):
+    metrics = MetricsRegistry()
+    metrics.add_collector(lambda: collect_app_metrics(app))
+    app['metrics'] = metrics
+
+
+class MetricsRegistry:
+    """
+    Per-process request metrics in the Prometheus text format.
+
+    Counters are plain ints and histograms have fixed buckets, the event loop
+    is single-threaded so no locks are needed. Collectors add metrics
+    of other components on rendering
+    """
+
+    def __init__(self):
+        self.requests = {}  # (route, method, status): count
+        self.latency = {}  # (route, method): Histogram
+        self.db_time = {}  # (route, method): Histogram
+        self.queries = {}  # (route, method): Histogram
+        self.collectors = []
+
+    def observe_request(self, route, method, status, duration, db_time=None, queries=None):
+        key = (route, method, status)
+        self.requests[key] = self.requests.get(key, 0) + 1
+
+        key = (route, method)
+        latency = self.latency.get(key)
+        if latency is None:
+            latency = self.latency[key] = Histogram()
+        latency.observe(duration)
+
+        if db_time is not None:
+            histogram = self.db_time.get(key)
+            if histogram is None:
+                histogram = self.db_time[key] = Histogram()
+            histogram.observe(db_time)
+
+        if queries is not None:
+            histogram = self.queries.get(key)
+            if histogram is None:
+                histogram = self.queries[key] = Histogram(QUERY_BUCKETS)
+            histogram.observe(queries)
+
+    def add_collector(self, collector):
+        """
+        collector returns the list of lines in the Prometheus text format
+        """
+        self.collectors.append(collector)
+
+    def render(self):
+        lines = render_counter(
+            'http_requests_total', 'Total HTTP requests',
+            [({'route': route, 'method': method, 'status': status}, count)
+             for (route, method, status), count in self.requests.items()],
+        )
+        lines += render_histogram(
+            'http_request_duration_seconds', 'HTTP request latency',
+            [({'route': route, 'method': method}, histogram) for (route, method), histogram in self.latency.items()],
+        )
+        lines += render_histogram(
+            'http_request_db_seconds', 'Database time per HTTP request',
+            [({'route': route, 'method': method}, histogram) for (route, method), histogram in self.db_time.items()],
+        )
+        lines += render_histogram(
+            'http_request_queries', 'Database queries per HTTP request',
+            [({'route': route, 'method': method}, histogram) for (route, method), histogram in self.queries.items()],
+        )
+        for collector in self.collectors:
+            lines += collector()
+        return '\n'.join(lines) + '\n'
+
+
+def collect_app_metrics(app):
+    """
+    Auth and user read caches, password hasher, database pool, slow query and logging metrics
+    """
+    lines = []
+    cache = app['auth_cache'].stats()
+    lines += render_counter('auth_cache_hits_total', 'Identity cache hits', [({}, cache['hits'])])
+    lines += render_counter('auth_cache_misses_total', 'Identity cache misses', [({}, cache['misses'])])
+    lines += render_gauge('auth_cache_size', 'Identity cache entries', [({}, cache['size'])])
+
+    reads = app['model']['user'].read_stats()
+    for key, description in (
+        ('calls', 'User reads by slug sent to the storage'),
+        ('coalesced', 'User reads by slug joined to a read in flight'),
+        ('cache_hits', 'User read cache hits'),
+        ('cache_misses', 'User read cache misses'),
+    ):
+        if key in reads:
+            lines += render_counter(f'user_read_{key}_total', description, [({}, reads[key])])
+
+    hasher = app['hasher']
+    lines += render_counter('hasher_calls_total', 'Password hash and verify calls', [({}, hasher.calls)])
+    lines += render_gauge('hasher_pending', 'Password hasher calls in progress', [({}, hasher.pending)])
+    lines += render_gauge('hasher_waiting', 'Password hasher calls waiting for the executor', [({}, hasher.waiting)])
+    lines += render_gauge(
+        'hasher_bulk_waiting', 'Password hasher bulk calls waiting for the executor', [({}, hasher.bulk_waiting)]
+    )
+    lines += render_counter(
+        'hasher_rejected_total', 'Password hasher calls rejected on queue overflow', [({}, hasher.rejected)]
+    )
+    lines += render_histogram(
+        'hasher_queue_wait_seconds', 'Password hasher queue wait time', [({}, hasher.wait_histogram)]
+    )
+
+    # database components are set by the storage backends that have them
+    telemetry = app.get('pool_telemetry')
+    if telemetry is not None and telemetry.engine is not None:
+        state = telemetry.pool_state()
+        for key in ('size', 'checked_in', 'checked_out', 'overflow'):
+            lines += render_gauge(f'db_pool_{key}', f'Database pool {key}', [({}, state[key])])
+        lines += render_counter('db_pool_timeouts_total', 'Database pool timeouts', [({}, state['timeouts'])])
+        lines += render_histogram(
+            'db_pool_wait_seconds', 'Database connection acquire time', [({}, telemetry.wait_time)]
+        )
+    lines += render_counter('log_records_dropped_total', 'Log records dropped on queue overflow', [({}, dropped_records())])
+    instrumentation = app.get('sql_instrumentation')
+    if instrumentation is not None:
+        lines += render_counter(
+            'db_slow_queries_total', 'Queries slower than the threshold', [({}, instrumentation.slow_queries)]
+        )
+    return lines
+
+
+def render_counter(name, description, samples):
+    return _render_samples(name, 'counter', description, samples)
+
+
+def render_gauge(name, description, samples):
+    return _render_samples(name, 'gauge', description, samples)
+
+
+def render_histogram(name, description, histograms):
+    lines = [f'# HELP {name} {description}', f'# TYPE {name} histogram']
+    for labels, histogram in histograms:
+        for bound, count in histogram.cumulative():
+            le = '+Inf' if bound == float('inf') else repr(bound)
+            lines.append(f'{name}_bucket{_render_labels({**labels, "le": le})} {count}')
+        lines.append(f'{name}_sum{_render_labels(labels)} {histogram.sum}')
+        lines.append(f'{name}_count{_render_labels(labels)} {histogram.count}')
+    return lines
+
+
+def _render_samples(name, metric_type, description, samples):
+    lines = [f'# HELP {name} {description}', f'# TYPE {name} {metric_type}']
+    for labels, value in samples:
+        lines.append(f'{name}{_render_labels(labels)} {value}')
+    return lines
+
+
+def _render_labels(labels):
+    if not labels:
+        return ''
+    pairs = []
+    for key, value in labels.items():
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        pairs.append(f'{key}="{value}"')
+    return '{' + ','.join(pairs) + '}'
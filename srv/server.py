@@ -0,0 +1,121 @@
+import os
+import time
+import signal
+import logging
+
+from aiohttp import web
+
+from srv.settings.app import create_app
+from srv.settings.log import setup_logging, AccessLogger
+
+
+logger = logging.getLogger(__name__)
+
+
+def install_uvloop():
+    """
+    Using uvloop event loop if it's installed
+    """
+    try:
+        import uvloop
+    except ImportError:
+        logger.warning('uvloop is not installed, using the default event loop')
+        return
+    uvloop.install()
+
+
+def run_worker(host, port, reuse_port=False, uvloop=False, shutdown_timeout=60):
+    """
+    Running the application in the current process until SIGINT/SIGTERM
+    """
+    setup_logging()
+    if uvloop:
+        install_uvloop()
+    web.run_app(
+        create_app(), host=host, port=port, reuse_port=reuse_port, shutdown_timeout=shutdown_timeout,
+        access_log_class=AccessLogger,
+    )
+
+
+class Supervisor:
+    """
+    Pre-fork process manager.
+
+    Each worker binds its own listening socket with SO_REUSEPORT, so the kernel
+    balances connections between them, and creates its own engine and pool on startup.
+    Exited workers are restarted, SIGTERM/SIGINT stops workers gracefully
+    and kills them after the shutdown timeout. Workers set up their own
+    logging listener, as threads don't survive fork.
+    """
+
+    restart_delay = 1
+
+    def __init__(self, host, port, workers, uvloop=False, shutdown_timeout=60):
+        self.host = host
+        self.port = port
+        self.workers = workers
+        self.uvloop = uvloop
+        self.shutdown_timeout = shutdown_timeout
+        self.children = set()
+        self.stopping = False
+
+    def run(self):
+        setup_logging()
+        signal.signal(signal.SIGTERM, self._on_stop)
+        signal.signal(signal.SIGINT, self._on_stop)
+        signal.signal(signal.SIGALRM, self._on_timeout)
+
+        logger.info('Starting %s workers on %s:%s', self.workers, self.host, self.port)
+        for _ in range(self.workers):
+            self._spawn()
+
+        while self.children:
+            try:
+                pid, status = os.wait()
+            except ChildProcessError:
+                break
+            self.children.discard(pid)
+            if not self.stopping:
+                logger.warning('Worker %s exited with status %s, restarting', pid, status)
+                time.sleep(self.restart_delay)
+                if not self.stopping:
+                    self._spawn()
+        logger.info('All workers stopped')
+
+    def _spawn(self):
+        pid = os.fork()
+        if pid == 0:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            signal.signal(signal.SIGALRM, signal.SIG_DFL)
+            code = 0
+            try:
+                run_worker(
+                    self.host, self.port, reuse_port=True, uvloop=self.uvloop,
+                    shutdown_timeout=self.shutdown_timeout,
+                )
+            except BaseException:
+                logger.exception('Worker %s failed', os.getpid())
+                code = 1
+            finally:
+                os._exit(code)
+        self.children.add(pid)
+
+    def _on_stop(self, signum, frame):
+        if self.stopping:
+            return
+        self.stopping = True
+        logger.info('Stopping workers')
+        self._signal_children(signal.SIGTERM)
+        signal.alarm(int(self.shutdown_timeout) + 5)
+
+    def _on_timeout(self, signum, frame):
+        logger.warning('Workers are not stopped in time, killing')
+        self._signal_children(signal.SIGKILL)
+
+    def _signal_children(self, signum):
+        for pid in list(self.children):
+            try:
+                os.kill(pid, signum)
+            except ProcessLookupError:
+                self.children.discard(pid)
@@ -2,12 +2,23 @@ from aiohttp import web
 from aiohttp_apispec import setup_aiohttp_apispec
 
 from srv.store.pg.accessor import setup_accessors
+from srv.store.memory.accessor import setup_memory_accessors
+from srv.actions.authorization import setup_auth_cache
+from srv.actions.hashing import setup_hasher
 from srv.actions.managers import setup_model_managers
+from srv.metrics import setup_metrics
 from srv.settings.config import CONFIG
 from srv.web.routes import routes_list
 from srv.web.middlewares import setup_middlewares
 
 
+# storage backends by the config['storage']
+STORAGES = {
+    'postgres': setup_accessors,
+    'memory': setup_memory_accessors,
+}
+
+
 async def create_app():
     """
     Server initialization and configuration
@@ -15,8 +26,11 @@ async def create_app():
     app = web.Application()
     app['config'] = CONFIG
     app.add_routes(routes_list)
-    setup_accessors(app)
+    setup_auth_cache(app)
+    setup_hasher(app)
+    STORAGES[app['config']['storage']](app)
     setup_model_managers(app)
+    setup_metrics(app)
     setup_middlewares(app)
     setup_aiohttp_apispec(app, swagger_path=app['config']['docs_url'])
     return app
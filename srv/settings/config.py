@@ -1,7 +1,5 @@
 import os
-import sys
 import pathlib
-import logging
 from sqlalchemy.engine import URL
 
 
@@ -19,16 +17,80 @@ CONFIG = {
         port=os.environ.get('SQL_PORT', '5432'),
         query={},
     ),
+    # 'postgres' or 'memory', the process-local storage without a database server
+    'storage': os.environ.get('STORAGE', 'postgres'),
+    # engine pool of each server worker,
+    # the database must accept workers * (pool_size + max_overflow) connections
+    'db_pool': {
+        'echo': os.environ.get('DB_ECHO', '0') == '1',  # logs every statement, see 'sql' for the slow query log
+        'pool_size': int(os.environ.get('DB_POOL_SIZE', 5)),
+        'max_overflow': int(os.environ.get('DB_MAX_OVERFLOW', 10)),
+        'pool_timeout': float(os.environ.get('DB_POOL_TIMEOUT', 30)),  # seconds to wait for a connection
+        'pool_pre_ping': os.environ.get('DB_POOL_PRE_PING', '0') == '1',
+        'pool_recycle': int(os.environ.get('DB_POOL_RECYCLE', -1)),  # seconds, -1 disables
+        'statement_cache_size': int(os.environ.get('DB_STATEMENT_CACHE_SIZE', 100)),  # asyncpg
+        'prepared_statement_cache_size': int(os.environ.get('DB_PREPARED_STATEMENT_CACHE_SIZE', 100)),  # sqlalchemy
+        'telemetry_interval': int(os.environ.get('DB_POOL_TELEMETRY_INTERVAL', 60)),  # seconds, 0 disables logging
+    },
+    # statement hooks: queries slower than slow_query_time (seconds) are logged,
+    # explain_sample_rate of the slow SELECTs are logged with EXPLAIN (ANALYZE, BUFFERS)
+    'sql': {
+        'slow_query_time': float(os.environ.get('SQL_SLOW_QUERY_TIME', 0.1)),
+        'explain_sample_rate': float(os.environ.get('SQL_EXPLAIN_SAMPLE_RATE', 0)),
+    },
+    # workers > 1 runs the pre-fork supervisor with SO_REUSEPORT workers
+    'server': {
+        'host': os.environ.get('SERVER_HOST', '0.0.0.0'),
+        'port': int(os.environ.get('SERVER_PORT', 8080)),
+        'workers': int(os.environ.get('SERVER_WORKERS', 1)),
+        'uvloop': os.environ.get('SERVER_UVLOOP', '0') == '1',
+        'shutdown_timeout': 60,
+    },
     'log_path': 'srv.log',
+    # records are written by a listener thread from a bounded queue, dropped when it's full,
+    # access_sample_rates maps route names to the share of logged requests, e.g. LOG_ACCESS_SAMPLE=UserView=0.1
+    'logging': {
+        'level': os.environ.get('LOG_LEVEL', 'INFO'),
+        'format': os.environ.get('LOG_FORMAT', 'text'),  # 'text' or 'json', access records are always json
+        'queue_size': int(os.environ.get('LOG_QUEUE_SIZE', 10000)),
+        'access_sample_rates': {
+            route: float(rate) for route, _, rate in (
+                item.partition('=') for item in os.environ.get('LOG_ACCESS_SAMPLE', '').split(',') if item
+            )
+        },
+    },
     'cookie_key': 'fa5s3nuzsfhzlgnfdgv86g1rdg7sd361',  # length must be 32 characters
+    # session storage: 'database' - the storage backend (the unlogged session table of postgres),
+    # 'memory' - the worker process, sessions aren't shared between workers, 'cookie' - the encrypted cookie.
+    # Server-side sessions are cached by each worker for cache_ttl seconds, max_age and intervals in seconds
+    'session': {
+        'storage': os.environ.get('SESSION_STORAGE', 'database'),
+        'max_age': int(os.environ.get('SESSION_MAX_AGE', 7 * 24 * 3600)),
+        'maxsize': int(os.environ.get('SESSION_MAXSIZE', 100_000)),  # sessions of the memory storage
+        'cache_maxsize': int(os.environ.get('SESSION_CACHE_MAXSIZE', 10_000)),
+        'cache_ttl': float(os.environ.get('SESSION_CACHE_TTL', 5)),
+        'cleanup_interval': int(os.environ.get('SESSION_CLEANUP_INTERVAL', 600)),  # expired rows, 0 disables
+    },
     'docs_url': '/backend',
+    # identity cache of the authorization policy, ttl in seconds. Writes invalidate it in all workers
+    # through the user_auth_changed notifications, the ttl bounds staleness if the listener connection is lost
+    'auth_cache': {'maxsize': 1024, 'ttl': 30},
+    # rows of GET /user/{slug} cached by each worker for ttl seconds, 0 disables,
+    # concurrent reads of a slug share one query regardless of it
+    'read_cache': {
+        'maxsize': int(os.environ.get('USER_READ_CACHE_MAXSIZE', 10_000)),
+        'ttl': float(os.environ.get('USER_READ_CACHE_TTL', 0)),
+    },
+    'json': os.environ.get('JSON_LIBRARY', 'orjson'),  # response encoder, 'orjson' falls back to 'json' if not installed
+    'import_batch_size': 1000,  # rows validated and copied at once by the bulk user import
+    # password hashing executor: 'process' or 'thread', max_workers defaults to the number of cores,
+    # max_concurrency limits the calls submitted to the executor at once (max_workers * 4 by default),
+    # logins and single creates get 503 when max_queue calls (max_concurrency * 16) already wait for it
+    'hasher': {
+        'executor': os.environ.get('HASHER_EXECUTOR', 'process'),
+        'max_workers': int(os.environ.get('HASHER_WORKERS', 0)) or None,
+        'max_concurrency': int(os.environ.get('HASHER_CONCURRENCY', 0)) or None,
+        'max_queue': int(os.environ.get('HASHER_QUEUE', 0)) or None,
+        'max_bulk_concurrency': int(os.environ.get('HASHER_BULK_CONCURRENCY', 0)) or None,
+    },
 }
-
-logging.basicConfig(
-    level=logging.INFO,
-    format="%(asctime)s [%(levelname)s] %(message)s",
-    handlers=[
-        logging.FileHandler(BASE_DIR / CONFIG['log_path']),
-        logging.StreamHandler(sys.stdout)
-    ],
-)
@@ -0,0 +1,144 @@
+import os
+import sys
+import json
+import queue
+import atexit
+import random
+import logging
+from logging.handlers import QueueHandler, QueueListener
+
+from aiohttp.abc import AbstractAccessLogger
+
+from srv.settings.config import BASE_DIR, CONFIG
+
+
+TEXT_FORMAT = '%(asctime)s [%(levelname)s] %(message)s'
+
+_listener = None
+_listener_pid = None
+_queue_handler = None
+
+
+def setup_logging(config=CONFIG):
+    """
+    Queue-based logging of the current process.
+
+    Records are put to a bounded queue on the event loop and written
+    to the file and stdout by the listener thread. Must be called in each
+    worker after fork, the listener thread doesn't survive it
+    """
+    global _listener, _listener_pid, _queue_handler
+    log_config = config['logging']
+
+    if _listener is not None and _listener_pid == os.getpid():
+        _listener.stop()
+
+    formatter = LogFormatter(json_format=log_config['format'] == 'json')
+    handlers = [logging.FileHandler(BASE_DIR / config['log_path']), logging.StreamHandler(sys.stdout)]
+    for handler in handlers:
+        handler.setFormatter(formatter)
+
+    records = queue.Queue(log_config['queue_size'])
+    _queue_handler = DroppingQueueHandler(records)
+    _listener = QueueListener(records, *handlers, respect_handler_level=True)
+    _listener_pid = os.getpid()
+
+    root = logging.getLogger()
+    root.handlers = [_queue_handler]
+    root.setLevel(log_config['level'])
+    _listener.start()
+    atexit.unregister(stop_logging)
+    atexit.register(stop_logging)
+
+
+def stop_logging():
+    """
+    Flushing the queue and stopping the listener thread
+    """
+    global _listener
+    if _listener is not None and _listener_pid == os.getpid():
+        _listener.stop()
+    _listener = None
+
+
+def dropped_records():
+    """
+    Number of records dropped on the queue overflow
+    """
+    return _queue_handler.dropped if _queue_handler is not None else 0
+
+
+class DroppingQueueHandler(QueueHandler):
+    """
+    Queue handler that never blocks, records are dropped and counted when the queue is full
+    """
+
+    def __init__(self, records):
+        super().__init__(records)
+        self.dropped = 0
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class LogFormatter(logging.Formatter):
+    """
+    Text or JSON lines. Structured records (with the fields attribute) are always JSON
+    """
+
+    def __init__(self, json_format=False):
+        super().__init__(TEXT_FORMAT)
+        self.json_format = json_format
+
+    def format(self, record):
+        fields = getattr(record, 'fields', None)
+        if fields is None and not self.json_format:
+            return super().format(record)
+        data = {
+            'time': self.formatTime(record),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        if fields:
+            data.update(fields)
+        if record.exc_info:
+            data['exc_info'] = self.formatException(record.exc_info)
+        return json.dumps(data, default=str)
+
+
+class AccessLogger(AbstractAccessLogger):
+    """
+    Structured access log with sampling.
+
+    config['logging']['access_sample_rates'] maps route names to the share
+    of requests logged, errors are always logged
+    """
+
+    def __init__(self, logger, log_format):
+        super().__init__(logger, log_format)
+        self.sample_rates = CONFIG['logging']['access_sample_rates']
+
+    def log(self, request, response, time):
+        route = request.get('route_name', 'unmatched')
+        rate = self.sample_rates.get(route, 1.0)
+        if response.status < 400 and rate < 1.0 and random.random() >= rate:
+            return
+
+        fields = {
+            'remote': request.remote,
+            'method': request.method,
+            'path': request.path,
+            'route': route,
+            'status': response.status,
+            'duration': round(time, 6),
+            'size': response.body_length,
+        }
+        stats = request.get('query_stats')
+        if stats is not None:
+            fields['queries'] = stats.queries
+            fields['db_time'] = round(stats.db_time, 6)
+        self.logger.info('access', extra={'fields': fields})
@@ -0,0 +1,210 @@
+import abc
+
+from aiohttp_session import session_middleware
+from aiohttp_session.cookie_storage import EncryptedCookieStorage
+from aiohttp_security import setup as setup_security
+
+from srv.actions.authorization import DBAuthorizationPolicy, AuthSessionIdentityPolicy
+from srv.actions.sessions import MemorySessionStorage
+
+
+# transaction modes, see BaseAccessor.transaction
+AUTOCOMMIT = 'autocommit'
+SNAPSHOT = 'snapshot'
+READ_WRITE = 'read_write'
+
+
+class BaseAccessor(abc.ABC):
+    """
+    Storage backend: connections and the user manager.
+
+    Connections are async context managers, the connection they return
+    is passed to the manager methods as conn
+    """
+
+    def setup(self, app):
+        app.on_startup.append(self._on_connect)
+        app.on_shutdown.append(self._on_disconnect)
+
+    @abc.abstractmethod
+    async def _on_connect(self, app):
+        """
+        Opening the storage, must set app.db and call _setup_security
+        """
+
+    @abc.abstractmethod
+    async def _on_disconnect(self, app):
+        pass
+
+    @abc.abstractmethod
+    def create_user_manager(self, app):
+        pass
+
+    @abc.abstractmethod
+    def connect(self, **options):
+        """
+        Connection without commit
+        """
+
+    @abc.abstractmethod
+    def begin(self):
+        """
+        Connection with commit
+        """
+
+    def transaction(self, mode=READ_WRITE):
+        """
+        Connection for the transaction mode
+        """
+        if mode == READ_WRITE:
+            return self.begin()
+        return self.connect()
+
+    def lazy(self, _connect):
+        """
+        Request-scoped connection, by default the same as _connect
+        """
+        return _connect
+
+    def create_session_storage(self, app):
+        """
+        Session storage of the config, see CONFIG['session']
+        """
+        config = app['config']['session']
+        if config['storage'] == 'cookie':
+            cookie_key = bytes(app['config']['cookie_key'], 'utf-8')
+            return EncryptedCookieStorage(cookie_key, max_age=config['max_age'])
+        if config['storage'] == 'memory':
+            return MemorySessionStorage(config['maxsize'], max_age=config['max_age'])
+        return self.create_db_session_storage(app)
+
+    def create_db_session_storage(self, app):
+        """
+        Session storage of the backend, by default in the worker process
+        """
+        config = app['config']['session']
+        return MemorySessionStorage(config['maxsize'], max_age=config['max_age'])
+
+    def _setup_security(self, app):
+        app['session_storage'] = self.create_session_storage(app)
+        # run by the session middleware of srv.web.middlewares, outside the request connection scope
+        app['session_middleware'] = session_middleware(app['session_storage'])
+        setup_security(
+            app, AuthSessionIdentityPolicy(), DBAuthorizationPolicy(self, app['auth_cache'], app['model']['user'])
+        )
+
+
+class BaseUserManager(abc.ABC):
+    """
+    User storage operations.
+
+    Rows are the user row views with the id, name, surname, login, password,
+    date_of_birth, permissions (name) and version attributes, the version changes
+    with every write of the row. auth_version of the user is bumped by update
+    when the permission changes, see DBAuthorizationPolicy.
+    A repeated login raises sqlalchemy IntegrityError, it's the 400 response of the error middleware
+    """
+
+    def __init__(self, auth_cache, hasher):
+        self.auth_cache = auth_cache
+        self.hasher = hasher
+
+    @abc.abstractmethod
+    async def create(self, conn, data):
+        """
+        Returns the created row, None if the permission doesn't exist
+        """
+
+    @abc.abstractmethod
+    async def create_many(self, conn, data_list):
+        """
+        Returns the created rows
+        """
+
+    @abc.abstractmethod
+    async def bulk_create(self, conn, rows):
+        """
+        rows is a list of (line number, user data) in line order, the first line wins for repeated logins.
+        The passwords are hashed by hash_passwords beforehand, so the transaction doesn't wait for the hasher.
+        Returns the number of created users and the list of (line number, errors) of rejected rows
+        """
+
+    @abc.abstractmethod
+    async def read(self, conn, slug, fields=None):
+        """
+        Row by id or login, None if it doesn't exist.
+        fields is a tuple of the row attributes to read besides the id and version, None for all of them.
+        The backend may return more attributes
+        """
+
+    @abc.abstractmethod
+    async def read_version(self, conn, slug):
+        """
+        (id, version) of the user row by id or login, None if it doesn't exist
+        """
+
+    @abc.abstractmethod
+    async def table_version(self, conn):
+        """
+        Version of the user list, changed by every committed write
+        """
+
+    @abc.abstractmethod
+    async def read_all(self, conn, limit=None, after=None, sort='id', fields=None, **filters):
+        """
+        Returns the page of filtered users and the keyset value of the next page.
+        sort is 'id' or 'login', '-' prefix for descending order, fields as in read
+        """
+
+    @abc.abstractmethod
+    async def stream_all(self, conn, batch_size=1000, **filters):
+        """
+        Yields batches of filtered users ordered by id
+        """
+        yield
+
+    @abc.abstractmethod
+    async def update(self, conn, slug, data):
+        """
+        Returns the updated row, None if it doesn't exist
+        """
+
+    @abc.abstractmethod
+    async def delete(self, conn, slug):
+        """
+        Returns the number of deleted users
+        """
+
+    @abc.abstractmethod
+    async def get_auth_version(self, conn, login):
+        """
+        (id, auth_version) of the user, None if it doesn't exist
+        """
+
+    @abc.abstractmethod
+    async def get_credentials(self, conn, login):
+        """
+        Row of the id, password (hash), permissions (name) and auth_version of the unblocked user
+        """
+
+    def read_stats(self):
+        """
+        Counters of the read coalescing and cache, empty if the backend has none
+        """
+        return {}
+
+    async def hash_passwords(self, data_list):
+        """
+        Bulk password hashing of the user data, in place
+        """
+        passwords = await self.hasher.hash_many(data['password'] for data in data_list)
+        for data, password in zip(data_list, passwords):
+            data['password'] = password
+
+    async def _set_password(self, data):
+        """
+        Password hashing
+        """
+        if not data.get('password'):
+            return
+        data['password'] = await self.hasher.hash(data['password'])
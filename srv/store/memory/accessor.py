@@ -0,0 +1,75 @@
+from datetime import date
+
+from srv.store.base import BaseAccessor
+from .managers import MemoryUserManager
+
+
+def setup_memory_accessors(app):
+    db_accessor = MemoryAccessor()
+    db_accessor.setup(app)
+    app['db_accessor'] = db_accessor
+
+
+class MemoryStore:
+    """
+    Tables of the in-memory storage
+    """
+
+    def __init__(self):
+        self.users = {}  # id: user data with the permission id
+        self.logins = {}  # login: id
+        self.permissions = {'block': 1, 'admin': 2, 'read': 3}
+        self.last_id = 0
+        self.version = 0  # bumped by every write, the version of the written rows
+
+
+class MemoryAccessor(BaseAccessor):
+    """
+    Process-local storage without a database server.
+
+    Each manager operation is applied at once after its awaits,
+    there are no transactions, so every connection is the store itself
+    """
+
+    def __init__(self):
+        self.store = None
+
+    async def _on_connect(self, app):
+        self.store = MemoryStore()
+        app.db = self
+        await app['model']['user'].create(self.store, {
+            'name': 'admin',
+            'surname': 'admin',
+            'login': 'admin',
+            'password': 'admin',
+            'date_of_birth': date.fromisoformat('1970-01-01'),
+            'permissions': 'admin',
+        })
+        self._setup_security(app)
+
+    async def _on_disconnect(self, app):
+        self.store = None
+
+    def create_user_manager(self, app):
+        return MemoryUserManager(app['auth_cache'], app['hasher'])
+
+    def connect(self, **options):
+        return MemoryConnect(self.store)
+
+    def begin(self):
+        return MemoryConnect(self.store)
+
+
+class MemoryConnect:
+    """
+    Connection context of the in-memory storage
+    """
+
+    def __init__(self, store):
+        self.store = store
+
+    async def __aenter__(self):
+        return self.store
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        pass
@@ -0,0 +1,195 @@
+from collections import namedtuple
+
+from sqlalchemy.exc import IntegrityError
+
+from srv.store.base import BaseUserManager
+
+
+UserRow = namedtuple(
+    'UserRow', ['id', 'name', 'surname', 'login', 'password', 'date_of_birth', 'permissions', 'version'],
+    defaults=[None],
+)
+CredentialsRow = namedtuple('CredentialsRow', ['id', 'password', 'permissions', 'auth_version'])
+
+
+def duplicate_login(login):
+    return IntegrityError('INSERT INTO user', {'login': login}, ValueError('Repeated login'))
+
+
+class MemoryUserManager(BaseUserManager):
+    """
+    User operations of the in-memory storage, conn is the MemoryStore
+    """
+
+    async def create(self, conn, data):
+        await self._set_password(data)
+        return self._insert(conn, [data])[0]
+
+    async def create_many(self, conn, data_list):
+        if not data_list:
+            return []
+        passwords = await self.hasher.hash_many(data['password'] for data in data_list)
+        for data, password in zip(data_list, passwords):
+            data['password'] = password
+        return [row for row in self._insert(conn, data_list) if row is not None]
+
+    async def bulk_create(self, conn, rows):
+        created, errors = 0, []
+        for line, data in rows:
+            if data['login'] in conn.logins:
+                errors.append((line, {'login': ['User with this login already exists']}))
+                continue
+            self._insert(conn, [dict(data)])
+            created += 1
+        return created, errors
+
+    async def read(self, conn, slug, fields=None):
+        user_id = self._get_id(conn, slug)
+        return self._row(conn, conn.users[user_id]) if user_id is not None else None
+
+    async def read_version(self, conn, slug):
+        user_id = self._get_id(conn, slug)
+        return (user_id, conn.users[user_id]['version']) if user_id is not None else None
+
+    async def table_version(self, conn):
+        return conn.version
+
+    async def read_all(self, conn, limit=None, after=None, sort='id', fields=None, **filters):
+        field = sort.lstrip('-')
+        descending = sort.startswith('-')
+
+        rows = sorted(self._select(conn, **filters), key=lambda row: getattr(row, field), reverse=descending)
+        if after is not None:
+            rows = [row for row in rows if (getattr(row, field) < after if descending else getattr(row, field) > after)]
+        if limit and len(rows) > limit:
+            rows = rows[:limit]
+            return rows, getattr(rows[-1], field)
+        return rows, None
+
+    async def stream_all(self, conn, batch_size=1000, **filters):
+        rows = sorted(self._select(conn, **filters), key=lambda row: row.id)
+        for start in range(0, len(rows), batch_size):
+            yield rows[start:start + batch_size]
+
+    async def update(self, conn, slug, data):
+        await self._set_password(data)
+        user_id = self._get_id(conn, slug)
+        if user_id is None:
+            return None
+        user = conn.users[user_id]
+        # permissions default to 'read' as in the database manager
+        perm_id = conn.permissions.get(data.get('permissions', 'read'))
+        login = data.get('login', user['login'])
+        if login != user['login'] and login in conn.logins:
+            raise duplicate_login(login)
+
+        del conn.logins[user['login']]
+        self.auth_cache.invalidate(user['login'], login)
+        if perm_id != user['permissions']:
+            user['auth_version'] += 1
+        user.update(data, permissions=perm_id, version=self._next_version(conn))
+        conn.logins[login] = user_id
+        return self._row(conn, user)
+
+    async def delete(self, conn, slug):
+        user_id = self._get_id(conn, slug)
+        if user_id is None:
+            return 0
+        user = conn.users.pop(user_id)
+        self._next_version(conn)
+        del conn.logins[user['login']]
+        self.auth_cache.invalidate(user['login'])
+        return 1
+
+    async def get_auth_version(self, conn, login):
+        user_id = conn.logins.get(login)
+        return (user_id, conn.users[user_id]['auth_version']) if user_id is not None else None
+
+    async def get_credentials(self, conn, login):
+        user = self._get_unblocked(conn, login)
+        if user is None:
+            return None
+        return CredentialsRow(
+            user['id'], user['password'], self._perm_name(conn, user['permissions']), user['auth_version']
+        )
+
+    def _insert(self, conn, data_list):
+        """
+        Inserting all users or none of them, returns the rows, None for unknown permissions
+        """
+        logins = [data['login'] for data in data_list]
+        for login in logins:
+            if login in conn.logins or logins.count(login) > 1:
+                raise duplicate_login(login)
+
+        rows = []
+        for data in data_list:
+            conn.last_id += 1
+            user = {
+                'name': None, 'surname': None, 'date_of_birth': None, **data,
+                'id': conn.last_id, 'permissions': conn.permissions.get(data.get('permissions', 'read')),
+                'auth_version': 0, 'version': self._next_version(conn),
+            }
+            conn.users[user['id']] = user
+            conn.logins[user['login']] = user['id']
+            rows.append(self._row(conn, user))
+        self.auth_cache.invalidate(*logins)
+        return rows
+
+    def _select(self, conn, permissions=None, date_of_birth_from=None, date_of_birth_to=None, login_prefix=None):
+        """
+        Rows with optional filters, comparisons with a missing date are false as in SQL
+        """
+        for user in conn.users.values():
+            row = self._row(conn, user)
+            if row is None:
+                continue
+            if permissions is not None and row.permissions != permissions:
+                continue
+            if date_of_birth_from is not None and (row.date_of_birth is None or row.date_of_birth < date_of_birth_from):
+                continue
+            if date_of_birth_to is not None and (row.date_of_birth is None or row.date_of_birth > date_of_birth_to):
+                continue
+            if login_prefix is not None and not row.login.startswith(login_prefix):
+                continue
+            yield row
+
+    def _row(self, conn, user):
+        """
+        Row view of the user, None without permissions as the inner join
+        """
+        perm_name = self._perm_name(conn, user['permissions'])
+        if perm_name is None:
+            return None
+        return UserRow(
+            user['id'], user['name'], user['surname'], user['login'], user['password'], user['date_of_birth'],
+            perm_name, user['version'],
+        )
+
+    def _get_unblocked(self, conn, login):
+        user_id = conn.logins.get(login)
+        if user_id is None:
+            return None
+        user = conn.users[user_id]
+        perm_name = self._perm_name(conn, user['permissions'])
+        if perm_name is None or perm_name == 'block':
+            return None
+        return user
+
+    @staticmethod
+    def _next_version(conn):
+        conn.version += 1
+        return conn.version
+
+    @staticmethod
+    def _perm_name(conn, perm_id):
+        for name, value in conn.permissions.items():
+            if value == perm_id:
+                return name
+        return None
+
+    @staticmethod
+    def _get_id(conn, slug):
+        if slug.isdigit():
+            return int(slug) if int(slug) in conn.users else None
+        return conn.logins.get(slug)
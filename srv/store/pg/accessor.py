@@ -1,72 +1,199 @@
-from aiohttp_session import setup as setup_session
-from aiohttp_session.cookie_storage import EncryptedCookieStorage
-from aiohttp_security import setup as setup_security
-from aiohttp_security import SessionIdentityPolicy
+from contextlib import asynccontextmanager
 
 from .options import create_db_engine
-from srv.actions.authorization import DBAuthorizationPolicy
+from .registry import PermissionsRegistry, AUTH_CHANNEL
+from .telemetry import PoolTelemetry
+from .instrumentation import SQLInstrumentation
+from .sessions import PostgresSessionStorage
+from .transaction import AFTER_COMMIT
+from srv.store.base import BaseAccessor, AUTOCOMMIT, SNAPSHOT, READ_WRITE
+from srv.actions.managers import UserManager
+from srv.actions.cache import TTLCache
 
 
+TRANSACTION_OPTIONS = {
+    AUTOCOMMIT: {'isolation_level': 'AUTOCOMMIT'},
+    SNAPSHOT: {'isolation_level': 'SERIALIZABLE', 'postgresql_readonly': True, 'postgresql_deferrable': True},
+}
+
 def setup_accessors(app):
     db_accessor = PostgresAccessor()
     db_accessor.setup(app)
+    app['db_accessor'] = db_accessor
+    app['permissions'] = db_accessor.permissions
+    app['pool_telemetry'] = db_accessor.telemetry
+    app['sql_instrumentation'] = db_accessor.instrumentation
 
 
-class PostgresAccessor:
+class PostgresAccessor(BaseAccessor):
     """
     Database connections, get transaction management
     """
 
     def __init__(self):
         self.engine = None
-
-    def setup(self, app):
-        app.on_startup.append(self._on_connect)
-        app.on_shutdown.append(self._on_disconnect)
+        self.permissions = PermissionsRegistry()
+        self.telemetry = PoolTelemetry()
+        self.instrumentation = SQLInstrumentation()
+        self.sessions = None
 
     async def _on_connect(self, app):
         self.engine = await create_db_engine()
+        self.instrumentation.setup(self.engine, **app['config']['sql'])
+        self.telemetry.start(self.engine, app['config']['db_pool']['telemetry_interval'])
+        # auth_version changes of the other workers, the cache is cleared if notifications could be missed
+        auth_cache = app['auth_cache']
+        self.permissions.subscribe(AUTH_CHANNEL, auth_cache.invalidate, auth_cache.clear)
+        await self.permissions.start(self.engine)
         app.db = self
-
-        cookie_key = bytes(app['config']['cookie_key'], 'utf-8')
-        setup_session(app, EncryptedCookieStorage(cookie_key))
-        setup_security(app, SessionIdentityPolicy(), DBAuthorizationPolicy(self))
+        self._setup_security(app)
+        if self.sessions is not None:
+            self.sessions.start(app['config']['session']['cleanup_interval'])
 
     async def _on_disconnect(self, app):
+        if self.sessions is not None:
+            await self.sessions.stop()
+        await self.permissions.stop()
+        await self.telemetry.stop()
+        await self.instrumentation.stop()
         if self.engine is not None:
             await self.engine.dispose()
 
-    def connect(self):
+    def create_user_manager(self, app):
+        config = app['config']['read_cache']
+        read_cache = TTLCache(config['maxsize'], config['ttl']) if config['ttl'] else None
+        return UserManager(app['auth_cache'], app['hasher'], self.permissions, read_cache)
+
+    def create_db_session_storage(self, app):
+        config = app['config']['session']
+        self.sessions = PostgresSessionStorage(
+            self, config['cache_maxsize'], config['cache_ttl'], max_age=config['max_age']
+        )
+        return self.sessions
+
+    def connect(self, **options):
         """
         Database connection without commit
         """
         if self.engine is None:
             return
-        _connect = PGConnect(self.engine)
+        _connect = PGConnect(self.engine, _options=options, _telemetry=self.telemetry)
         return _connect
 
     def begin(self):
         """
         Database connection with commit
         """
-        _connect = PGConnect(self.engine, True)
+        _connect = PGConnect(self.engine, True, _telemetry=self.telemetry)
         return _connect
 
+    def transaction(self, mode=READ_WRITE):
+        """
+        Database connection for the transaction mode:
+        AUTOCOMMIT - read-only queries without BEGIN/COMMIT,
+        SNAPSHOT - READ ONLY DEFERRABLE snapshot, rolled back on close,
+        READ_WRITE - transaction with commit
+        """
+        if mode == READ_WRITE:
+            return self.begin()
+        return self.connect(**TRANSACTION_OPTIONS[mode])
+
+    def lazy(self, _connect):
+        """
+        Request-scoped connection, checked out from the pool on first use
+        """
+        return PGLazyConnect(_connect)
+
 
 class PGConnect:
     """
-    Transaction management
+    Transaction management.
+
+    Callbacks registered by after_commit are called after the commit
+    and dropped on rollback
     """
 
-    def __init__(self, engine, _is_transaction=False):
+    def __init__(self, engine, _is_transaction=False, _options=None, _telemetry=None):
         self.engine = engine
         self._is_transaction = _is_transaction
+        self._options = _options
+        self._telemetry = _telemetry
 
     async def __aenter__(self):
-        self.conn = await self.engine.connect()
+        if self._telemetry is None:
+            self.conn = await self.engine.connect()
+        else:
+            self.conn = await self._telemetry.connect(self.engine)
+        if self._options:
+            await self.conn.execution_options(**self._options)
+        if self._is_transaction:
+            self.conn.info[AFTER_COMMIT] = []
         return self.conn
 
     async def __aexit__(self, exc_type, exc_val, exc_tb):
-        if self._is_transaction and not exc_type:
-            await self.conn.commit()
-        await self.conn.close()
+        # info belongs to the pooled connection, it is cleared before the checkin
+        callbacks = self.conn.info.pop(AFTER_COMMIT, [])
+        try:
+            if self._is_transaction and not exc_type:
+                await self.conn.commit()
+            else:
+                callbacks = []
+        finally:
+            await self.conn.close()
+        for callback in callbacks:
+            callback()
+
+
+class PGLazyConnect:
+    """
+    Deferred transaction management.
+
+    Wraps PGConnect and enters it only when a query is executed,
+    so requests that never reach the database don't hold a pool connection
+    """
+
+    def __init__(self, connect):
+        self._connect = connect
+        self._conn = None
+
+    @property
+    def acquired(self):
+        return self._conn is not None
+
+    @property
+    def info(self):
+        return self._conn.info if self._conn is not None else {}
+
+    async def acquire(self):
+        """
+        Returns the underlying connection, checking it out if needed
+        """
+        if self._conn is None:
+            self._conn = await self._connect.__aenter__()
+        return self._conn
+
+    async def execute(self, *args, **kwargs):
+        conn = await self.acquire()
+        return await conn.execute(*args, **kwargs)
+
+    async def scalar(self, *args, **kwargs):
+        conn = await self.acquire()
+        return await conn.scalar(*args, **kwargs)
+
+    async def get_raw_connection(self):
+        conn = await self.acquire()
+        return await conn.get_raw_connection()
+
+    @asynccontextmanager
+    async def stream(self, *args, **kwargs):
+        conn = await self.acquire()
+        async with conn.stream(*args, **kwargs) as result:
+            yield result
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        if self._conn is not None:
+            self._conn = None
+            await self._connect.__aexit__(exc_type, exc_val, exc_tb)
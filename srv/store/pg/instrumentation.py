@@ -0,0 +1,114 @@
+import time
+import random
+import asyncio
+import logging
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from sqlalchemy import event
+
+
+logger = logging.getLogger(__name__)
+
+# query stats of the current request, SQLAlchemy greenlets share the context of the task
+current_stats = ContextVar('query_stats', default=None)
+
+
+class QueryStats:
+    """
+    Number of queries and time spent in them
+    """
+    __slots__ = ('queries', 'db_time')
+
+    def __init__(self):
+        self.queries = 0
+        self.db_time = 0.0
+
+
+@contextmanager
+def track_queries():
+    """
+    Collecting stats of the queries executed in the block by the current task
+    """
+    stats = QueryStats()
+    token = current_stats.set(stats)
+    try:
+        yield stats
+    finally:
+        current_stats.reset(token)
+
+
+class SQLInstrumentation:
+    """
+    Cursor execute hooks of the engine.
+
+    Each statement is timed and added to the stats of the current request,
+    statements slower than slow_query_time are logged. A share of slow
+    SELECTs (explain_sample_rate) is explained with ANALYZE and BUFFERS
+    on a separate connection, as it executes the statement once more
+    """
+
+    def __init__(self):
+        self.engine = None
+        self.slow_query_time = 0.1
+        self.explain_sample_rate = 0.0
+        self.slow_queries = 0
+        self._tasks = set()
+
+    def setup(self, engine, slow_query_time=0.1, explain_sample_rate=0.0):
+        self.engine = engine
+        self.slow_query_time = slow_query_time
+        self.explain_sample_rate = explain_sample_rate
+        event.listen(engine.sync_engine, 'before_cursor_execute', self._before_execute)
+        event.listen(engine.sync_engine, 'after_cursor_execute', self._after_execute)
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        if self.engine is not None:
+            event.remove(self.engine.sync_engine, 'before_cursor_execute', self._before_execute)
+            event.remove(self.engine.sync_engine, 'after_cursor_execute', self._after_execute)
+            self.engine = None
+
+    def _before_execute(self, conn, cursor, statement, parameters, context, executemany):
+        # kept on the execution context, failed statements don't reach _after_execute
+        if context is not None:
+            context._query_started = time.perf_counter()
+
+    def _after_execute(self, conn, cursor, statement, parameters, context, executemany):
+        started = getattr(context, '_query_started', None)
+        if started is None:
+            return
+        duration = time.perf_counter() - started
+        stats = current_stats.get()
+        if stats is not None:
+            stats.queries += 1
+            stats.db_time += duration
+
+        if duration < self.slow_query_time:
+            return
+        self.slow_queries += 1
+        logger.warning('Slow query (%.3fs): %s %r', duration, statement, parameters)
+        if (
+            not executemany
+            and statement.lstrip()[:6].upper() == 'SELECT'
+            and random.random() < self.explain_sample_rate
+        ):
+            self._spawn(self._explain(statement, parameters))
+
+    async def _explain(self, statement, parameters):
+        current_stats.set(None)  # the task copied the context of the request
+        async with self.engine.connect() as conn:
+            ret = await conn.exec_driver_sql('EXPLAIN (ANALYZE, BUFFERS) ' + statement, parameters)
+            plan = '\n'.join(row[0] for row in ret)
+        logger.warning('Slow query plan: %s\n%s', statement, plan)
+
+    def _spawn(self, coro):
+        task = asyncio.ensure_future(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._on_task_done)
+
+    def _on_task_done(self, task):
+        self._tasks.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            logger.error('Slow query explain failed', exc_info=task.exception())
@@ -1,4 +1,5 @@
-from sqlalchemy import MetaData, Table, Column, ForeignKey, Integer, String, Date
+from sqlalchemy import MetaData, Table, Column, ForeignKey, Index, Integer, BigInteger, String, Date, DateTime
+from sqlalchemy.dialects.postgresql import JSONB
 
 
 metadata = MetaData()
@@ -14,6 +15,12 @@ user = Table(
     Column('password', String(256), nullable=False),
     Column('date_of_birth', Date),
     Column('permissions', ForeignKey('permissions.id', ondelete='SET NULL')),
+    # bumped when the permission changes, sessions of older versions aren't authorized
+    Column('auth_version', Integer, nullable=False, server_default='0'),
+    # user list filters and keyset pagination
+    Index('ix_user_permissions_id', 'permissions', 'id'),
+    Index('ix_user_date_of_birth', 'date_of_birth'),
+    Index('ix_user_login_pattern', 'login', postgresql_ops={'login': 'varchar_pattern_ops'}),
 )
 
 
@@ -25,3 +32,44 @@ permissions = Table(
 )
 
 
+# versions of tables bumped by statement triggers on every write, see the migration
+table_version = Table(
+    'table_version',
+    metadata,
+    Column('name', String(64), primary_key=True),
+    Column('version', BigInteger, nullable=False, server_default='0'),
+)
+
+
+# server-side sessions, unlogged: not written to WAL, emptied after a crash
+session = Table(
+    'session',
+    metadata,
+    Column('key', String(64), primary_key=True),
+    Column('data', JSONB, nullable=False),
+    Column('expires', DateTime(timezone=True), nullable=False),
+    Index('ix_session_expires', 'expires'),
+    prefixes=['UNLOGGED'],
+)
+
+
+# temporary tables, created at runtime and not managed by migrations
+staging_metadata = MetaData()
+
+
+# staging table of the bulk user import, dropped on commit
+user_import = Table(
+    'user_import',
+    staging_metadata,
+    Column('line', Integer),
+    Column('name', String(32)),
+    Column('surname', String(32)),
+    Column('login', String(128)),
+    Column('password', String(256)),
+    Column('date_of_birth', Date),
+    Column('permissions', Integer),
+    prefixes=['TEMPORARY'],
+    postgresql_on_commit='DROP',
+)
+
+
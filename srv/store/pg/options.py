@@ -1,9 +1,9 @@
 from sqlalchemy.ext.asyncio import create_async_engine
 
-from passlib.hash import sha256_crypt
 from datetime import date
 
 from srv.settings.config import CONFIG
+from srv.actions.hashing import PasswordHasher
 from .models import user, permissions
 
 
@@ -11,15 +11,25 @@ async def create_db_engine():
     """
     Create database engine with default configuration
     """
+    pool = CONFIG['db_pool']
     engine = create_async_engine(
         CONFIG['db_url'],
-        echo=True,
+        echo=pool['echo'],
         future=True,
+        pool_size=pool['pool_size'],
+        max_overflow=pool['max_overflow'],
+        pool_timeout=pool['pool_timeout'],
+        pool_pre_ping=pool['pool_pre_ping'],
+        pool_recycle=pool['pool_recycle'],
+        connect_args={
+            'statement_cache_size': pool['statement_cache_size'],
+            'prepared_statement_cache_size': pool['prepared_statement_cache_size'],
+        },
     )
     return engine
 
 
-async def check_default_data(conn):
+async def check_default_data(conn, hasher=None):
     """
     Create default admin and permissions if they are not exist
     """
@@ -38,19 +48,20 @@ async def check_default_data(conn):
         )
     )
     if not admin:
-        await create_admin(conn)
+        await create_admin(conn, hasher)
 
 
-async def create_admin(conn):
+async def create_admin(conn, hasher=None):
     """
     Create default admin user
     """
+    hasher = hasher or PasswordHasher()
     await conn.execute(
         user.insert(), {
             'name': 'admin',
             'surname': 'admin',
             'login': 'admin',
-            'password': sha256_crypt.using().hash('admin'),
+            'password': await hasher.hash('admin'),
             'date_of_birth': date.fromisoformat('1970-01-01'),
             'permissions': 2,
         }
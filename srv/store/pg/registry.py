@@ -0,0 +1,128 @@
+import asyncio
+import logging
+
+import asyncpg
+import sqlalchemy as sa
+
+from .models import permissions
+
+
+# notification channel of the trigger on the permissions table
+PERMISSIONS_CHANNEL = 'permissions_changed'
+# notification channel of the user trigger, the payload is the login of a changed auth_version or deleted user
+AUTH_CHANNEL = 'user_auth_changed'
+
+logger = logging.getLogger(__name__)
+
+
+class PermissionsRegistry:
+    """
+    In-process map of permission names and ids.
+
+    Loaded on startup and reloaded on notifications of the permissions table trigger,
+    so all worker processes stay consistent without polling.
+    The listener uses its own connection outside of the engine pool,
+    other channels are listened to on it with subscribe.
+    """
+
+    reconnect_delay = 1
+
+    def __init__(self):
+        self.engine = None
+        self.by_name = {}
+        self.by_id = {}
+        self._listener = None
+        self._channels = {}
+        self._tasks = set()
+        self._closed = False
+
+    def subscribe(self, channel, callback, on_reconnect=None):
+        """
+        Listening to the channel from start, callback(payload) is called on notifications.
+        Notifications sent while the connection is lost are missed, on_reconnect() is called after reconnecting
+        """
+        self._channels[channel] = (callback, on_reconnect)
+
+    async def start(self, engine):
+        self.engine = engine
+        self._closed = False
+        await self._listen()
+        await self.reload()
+
+    async def stop(self):
+        self._closed = True
+        for task in self._tasks:
+            task.cancel()
+        if self._listener is not None:
+            await self._listener.close()
+            self._listener = None
+
+    async def reload(self, conn=None):
+        """
+        Loading the permissions table, with the conn if it's given
+        """
+        if conn is None:
+            async with self.engine.connect() as conn:
+                ret = await conn.execute(sa.select(permissions.c.id, permissions.c.perm_name))
+        else:
+            ret = await conn.execute(sa.select(permissions.c.id, permissions.c.perm_name))
+        rows = ret.fetchall()
+        self.by_id = dict(rows)
+        self.by_name = {name: perm_id for perm_id, name in rows}
+
+    async def get_id(self, conn, name):
+        """
+        Permission id by name, the registry is reloaded with the conn on a miss
+        """
+        if name not in self.by_name:
+            await self.reload(conn)
+        return self.by_name.get(name)
+
+    async def get_name(self, conn, perm_id):
+        """
+        Permission name by id, the registry is reloaded with the conn on a miss
+        """
+        if perm_id not in self.by_id:
+            await self.reload(conn)
+        return self.by_id.get(perm_id)
+
+    async def _listen(self):
+        dsn = self.engine.url.set(drivername='postgresql').render_as_string(hide_password=False)
+        self._listener = await asyncpg.connect(dsn)
+        self._listener.add_termination_listener(self._on_terminate)
+        await self._listener.add_listener(PERMISSIONS_CHANNEL, self._on_notify)
+        for channel, (callback, _) in self._channels.items():
+            await self._listener.add_listener(
+                channel, lambda connection, pid, channel, payload, callback=callback: callback(payload)
+            )
+
+    def _on_notify(self, connection, pid, channel, payload):
+        self._spawn(self.reload())
+
+    def _on_terminate(self, connection):
+        if not self._closed:
+            logger.warning('Permissions listener connection lost, reconnecting')
+            self._spawn(self._reconnect())
+
+    async def _reconnect(self):
+        while not self._closed:
+            await asyncio.sleep(self.reconnect_delay)
+            try:
+                await self._listen()
+                await self.reload()
+                for _, on_reconnect in self._channels.values():
+                    if on_reconnect is not None:
+                        on_reconnect()
+                return
+            except (OSError, asyncpg.PostgresError) as err:
+                logger.warning('Permissions listener reconnect failed: %s', err)
+
+    def _spawn(self, coro):
+        task = asyncio.ensure_future(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._on_task_done)
+
+    def _on_task_done(self, task):
+        self._tasks.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            logger.error('Permissions registry update failed', exc_info=task.exception())
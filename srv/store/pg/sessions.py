@@ -0,0 +1,96 @@
+import copy
+import asyncio
+import logging
+from datetime import timedelta
+
+import sqlalchemy as sa
+from sqlalchemy.dialects.postgresql import insert
+
+from srv.actions.cache import TTLCache, MISSING
+from srv.actions.sessions import ServerSessionStorage, IDENTITY_KEY
+from srv.store.base import AUTOCOMMIT
+from .models import session as session_table
+
+
+logger = logging.getLogger(__name__)
+
+
+class PostgresSessionStorage(ServerSessionStorage):
+    """
+    Storage in the unlogged session table, shared by the workers.
+
+    Loaded sessions are cached by each worker for cache_ttl seconds,
+    so a session deleted by another worker (revoke) is accepted until then.
+    Expired rows are deleted by the cleanup task
+    """
+
+    def __init__(self, db, cache_maxsize=10_000, cache_ttl=5, *, max_age=None, **kwargs):
+        super().__init__(max_age=max_age, **kwargs)
+        self.db = db
+        self.cache = TTLCache(cache_maxsize, cache_ttl)
+        self._task = None
+
+    def start(self, interval):
+        if interval:
+            self._task = asyncio.create_task(self._cleanup(interval))
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def load(self, key):
+        data = self.cache.get(key)
+        if data is MISSING:
+            generation = self.cache.generation
+            async with self.db.transaction(AUTOCOMMIT) as conn:
+                data = await conn.scalar(
+                    sa.select(session_table.c.data)
+                    .where(session_table.c.key == key, session_table.c.expires > sa.func.now())
+                )
+            self.cache.set(key, data, generation)
+        return copy.deepcopy(data)
+
+    async def save(self, key, data, max_age):
+        if max_age is None:
+            expires = sa.text("'infinity'::timestamptz")
+        else:
+            expires = sa.func.now() + timedelta(seconds=max_age)
+        query = insert(session_table).values(key=key, data=data, expires=expires)
+        query = query.on_conflict_do_update(
+            index_elements=[session_table.c.key],
+            set_={'data': query.excluded.data, 'expires': query.excluded.expires},
+        )
+        async with self.db.transaction(AUTOCOMMIT) as conn:
+            await conn.execute(query)
+        self.cache.set(key, copy.deepcopy(data))
+
+    async def delete(self, key):
+        self.cache.invalidate(key)
+        async with self.db.transaction(AUTOCOMMIT) as conn:
+            await conn.execute(sa.delete(session_table).where(session_table.c.key == key))
+
+    async def revoke(self, identity):
+        async with self.db.transaction(AUTOCOMMIT) as conn:
+            ret = await conn.execute(
+                sa.delete(session_table)
+                .where(session_table.c.data['session'][IDENTITY_KEY].astext == identity)
+                .returning(session_table.c.key)
+            )
+            keys = ret.scalars().all()
+        self.cache.invalidate(*keys)
+        return len(keys)
+
+    async def _cleanup(self, interval):
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                async with self.db.transaction(AUTOCOMMIT) as conn:
+                    ret = await conn.execute(sa.delete(session_table).where(session_table.c.expires <= sa.func.now()))
+                logger.info('Deleted %s expired sessions', ret.rowcount)
+            except Exception:
+                logger.exception('Session cleanup failed')
@@ -0,0 +1,70 @@
+import time
+import asyncio
+import logging
+
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+
+from srv.metrics import Histogram
+
+
+logger = logging.getLogger(__name__)
+
+
+class PoolTelemetry:
+    """
+    Engine pool state, connection acquire wait times and pool timeouts
+    """
+
+    def __init__(self):
+        self.engine = None
+        self.wait_time = Histogram()
+        self.timeouts = 0
+        self._task = None
+
+    def start(self, engine, interval=0):
+        """
+        Starting periodic logging of the pool state every interval seconds, 0 disables it
+        """
+        self.engine = engine
+        if interval:
+            self._task = asyncio.ensure_future(self._log_periodically(interval))
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    async def connect(self, engine):
+        """
+        Acquiring the engine connection with the wait time measurement
+        """
+        started = time.perf_counter()
+        try:
+            conn = await engine.connect()
+        except PoolTimeoutError:
+            self.timeouts += 1
+            raise
+        self.wait_time.observe(time.perf_counter() - started)
+        return conn
+
+    def pool_state(self):
+        pool = self.engine.pool
+        return {
+            'size': pool.size(),
+            'checked_in': pool.checkedin(),
+            'checked_out': pool.checkedout(),
+            'overflow': pool.overflow(),
+            'timeouts': self.timeouts,
+        }
+
+    def snapshot(self):
+        state = self.pool_state() if self.engine is not None else {'timeouts': self.timeouts}
+        return {**state, 'wait_time': self.wait_time.snapshot()}
+
+    async def _log_periodically(self, interval):
+        while True:
+            await asyncio.sleep(interval)
+            state = self.pool_state()
+            wait_time = self.wait_time
+            state['wait_time_avg'] = round(wait_time.sum / wait_time.count, 6) if wait_time.count else 0
+            logger.info('DB pool: %s', state)
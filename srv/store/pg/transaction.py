@@ -0,0 +1,14 @@
+# conn.info key of the callbacks run after the transaction of the connection commits
+AFTER_COMMIT = 'after_commit'
+
+
+def after_commit(conn, callback):
+    """
+    Calling the callback now and once more after the commit of the connection
+    with commit, so readers between the statement and the commit,
+    which still see the old rows, don't leave them cached
+    """
+    callback()
+    callbacks = conn.info.get(AFTER_COMMIT)
+    if callbacks is not None:
+        callbacks.append(callback)
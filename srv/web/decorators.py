@@ -0,0 +1,45 @@
+from aiohttp import web
+
+from srv.store.base import READ_WRITE
+
+
+def transaction(mode):
+    """
+    Declares the transaction mode of the view, see BaseAccessor.transaction
+    """
+    def wrapper(func):
+        func.__transaction__ = mode
+        return func
+    return wrapper
+
+
+def fast_validator(load):
+    """
+    Declares the loader of the JSON body tried before the schema validation of the view.
+    load returns the validated data or None to validate with the schema
+    """
+    def wrapper(func):
+        func.__fast_validator__ = load
+        return func
+    return wrapper
+
+
+def get_handler(request):
+    """
+    Returns the view function or the class-based view method of the request
+    """
+    handler = request.match_info.handler
+    if isinstance(handler, type) and issubclass(handler, web.View):
+        handler = getattr(handler, request.method.lower(), None)
+    return handler
+
+
+def get_transaction_mode(request):
+    """
+    Transaction mode declared by the view, read-write by default
+    """
+    return getattr(get_handler(request), '__transaction__', READ_WRITE)
+
+
+def get_fast_validator(request):
+    return getattr(get_handler(request), '__fast_validator__', None)
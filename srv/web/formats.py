@@ -0,0 +1,93 @@
+import io
+import csv
+import json
+
+from .serializers import dumps
+
+
+class NDJSONFormat:
+    """
+    Newline delimited JSON, one object per line.
+    header and dump return bytes
+    """
+    content_type = 'application/x-ndjson'
+
+    def header(self, fields):
+        return b''
+
+    def dump(self, items):
+        return b''.join(dumps(item) + b'\n' for item in items)
+
+    def load(self, line):
+        return json.loads(line)
+
+
+class CSVFormat:
+    """
+    CSV with the header line, empty value for null.
+    header and dump return bytes
+    """
+    content_type = 'text/csv'
+
+    def __init__(self):
+        self.fields = None
+
+    def header(self, fields):
+        self.fields = list(fields)
+        return self._write([self.fields])
+
+    def dump(self, items):
+        return self._write([item.get(field) for field in self.fields] for item in items)
+
+    def load(self, line):
+        """
+        Parsing the line, the first one is the header (returns None).
+        Empty values are omitted
+        """
+        values = next(csv.reader([line]))
+        if self.fields is None:
+            self.fields = values
+            return None
+        if len(values) != len(self.fields):
+            raise ValueError('Wrong number of values')
+        return {field: value for field, value in zip(self.fields, values) if value != ''}
+
+    @staticmethod
+    def _write(rows):
+        buffer = io.StringIO()
+        csv.writer(buffer, lineterminator='\n').writerows(rows)
+        return buffer.getvalue().encode()
+
+
+FORMATS = {
+    'ndjson': NDJSONFormat,
+    'csv': CSVFormat,
+}
+
+CONTENT_TYPES = {serializer.content_type: serializer for serializer in FORMATS.values()}
+
+
+async def read_batches(stream, parser, batch_size):
+    """
+    Yields batches of (line number, item) from the stream of lines,
+    item is None if the line can't be parsed
+    """
+    batch = []
+    line_num = 0
+    async for line in stream:
+        line_num += 1
+        try:
+            line = line.decode().strip()
+            if not line:
+                continue
+            item = parser.load(line)
+            if item is None:
+                continue
+        except ValueError:
+            item = None
+        batch.append((line_num, item))
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
@@ -1,33 +1,110 @@
+import time
+
 from aiohttp import web
-from aiohttp_apispec import validation_middleware
-from sqlalchemy.exc import IntegrityError, DBAPIError
+from aiohttp_apispec import validation_middleware as schema_validation_middleware
+from sqlalchemy.exc import IntegrityError, DBAPIError, TimeoutError as PoolTimeoutError
+
+from .decorators import get_transaction_mode, get_fast_validator
+from srv.actions.hashing import HasherOverloaded
+from .serializers import json_response, loads
+from srv.store.pg.instrumentation import track_queries
 
 
 def setup_middlewares(app):
+    app.middlewares.append(metrics_middleware)
     app.middlewares.append(validation_middleware)
     app.middlewares.append(error_middleware)
+    app.middlewares.append(session_middleware)
     app.middlewares.append(db_connect_middleware)
 
 
+def get_route_name(request):
+    """
+    Route name or the handler name, 'unmatched' for not found routes
+    """
+    if request.match_info.http_exception is not None:
+        return 'unmatched'
+    route = request.match_info.route
+    return route.name or getattr(route.handler, '__name__', 'unknown')
+
+
+@web.middleware
+async def metrics_middleware(request, handler):
+    """
+    Request count, status, latency, database time and queries per route
+    """
+    started = time.perf_counter()
+    status = 500
+    request['route_name'] = get_route_name(request)
+    with track_queries() as stats:
+        request['query_stats'] = stats
+        try:
+            response = await handler(request)
+            status = response.status
+            return response
+        except web.HTTPException as exc:
+            status = exc.status
+            raise
+        finally:
+            request.app['metrics'].observe_request(
+                request['route_name'], request.method, status, time.perf_counter() - started,
+                stats.db_time, stats.queries,
+            )
+
+
+@web.middleware
+async def validation_middleware(request, handler):
+    """
+    Request validation of aiohttp_apispec, with the fast path of the view tried first.
+    Data rejected by the fast path is validated with the schema for the same error response
+    """
+    load = get_fast_validator(request)
+    if load is not None and request.content_type == 'application/json':
+        try:
+            data = load(loads(await request.read()))
+        except ValueError:
+            data = None
+        if data is not None:
+            request[request.app['_apispec_request_data_name']] = data
+            return await handler(request)
+    return await schema_validation_middleware(request, handler)
+
+
 @web.middleware
 async def error_middleware(request, handler):
     """
-    Middleware for errors related to incorrect data entry
+    Middleware for errors related to incorrect data entry and database overload
     """
     try:
         response = await handler(request)
     except (IntegrityError, DBAPIError):
-        return web.json_response({'error': 'Invalid data'}, status=400)
+        return json_response({'error': 'Invalid data'}, status=400)
+    except PoolTimeoutError:
+        return json_response({'error': 'Database is overloaded'}, status=503)
+    except HasherOverloaded:
+        return json_response({'error': 'Server is overloaded'}, status=503)
     return response
 
 
+@web.middleware
+async def session_middleware(request, handler):
+    """
+    Session middleware of the storage set up at startup.
+    The session is saved after the request connection is released,
+    so a request never holds two pool connections for it
+    """
+    return await request.app['session_middleware'](request, handler)
+
+
 @web.middleware
 async def db_connect_middleware(request, handler):
     """
-    Creating a database connection
+    Creating a request-scoped database connection, acquired on first use.
+    The transaction mode is declared by the view
     """
     db = request.app.db
-    async with db.begin() as conn:
-        request.app['conn'] = conn
+    mode = get_transaction_mode(request)
+    async with db.lazy(db.transaction(mode)) as conn:
+        request['conn'] = conn
         response = await handler(request)
     return response
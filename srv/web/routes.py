@@ -7,5 +7,9 @@ routes_list = [
     web.post('/login', views.login),
     web.post('/logout', views.logout),
     web.view('/user', views.UserView),
+    web.view('/export/user', views.UserExportView),
+    web.view('/import/user', views.UserImportView),
     web.view('/user/{slug}', views.UserDetailView),
+    web.get('/internal/pool', views.pool_telemetry),
+    web.get('/metrics', views.metrics),
 ]
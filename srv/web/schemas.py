@@ -1,4 +1,56 @@
-from marshmallow import Schema, fields, validate
+import json
+import base64
+import binascii
+
+from marshmallow import Schema, ValidationError, fields, validate, validates_schema
+
+
+def encode_cursor(sort, key):
+    """
+    Opaque pagination cursor from the sort order and the keyset value
+    """
+    return base64.urlsafe_b64encode(json.dumps([sort, key]).encode()).decode()
+
+
+class Cursor(fields.Field):
+    """
+    Pagination cursor field, deserialized to {'sort': ..., 'key': ...}
+    """
+
+    def _deserialize(self, value, attr, data, **kwargs):
+        try:
+            sort, key = json.loads(base64.urlsafe_b64decode(value.encode()))
+        except (ValueError, TypeError, binascii.Error):
+            raise ValidationError('Invalid cursor')
+        if not isinstance(key, (int, str)) or isinstance(key, bool):
+            raise ValidationError('Invalid cursor')
+        return {'sort': sort, 'key': key}
+
+
+class FieldList(fields.Field):
+    """
+    Comma-separated names of the choices, deserialized to a tuple in the choices order
+    """
+
+    def __init__(self, choices, **kwargs):
+        super().__init__(**kwargs)
+        self.choices = tuple(choices)
+
+    def _deserialize(self, value, attr, data, **kwargs):
+        if not isinstance(value, str):
+            raise ValidationError('Invalid field list')
+        names = set(value.split(','))
+        unknown = names.difference(self.choices)
+        if unknown:
+            raise ValidationError(f'Unknown fields: {", ".join(sorted(unknown))}')
+        return tuple(name for name in self.choices if name in names)
+
+
+def is_not_digits(value):
+    """
+    Logins can't look like ids
+    """
+    return not value.isdigit()
 
 
 class LoginSchema(Schema):
@@ -6,11 +58,28 @@ class LoginSchema(Schema):
     User session authorization schema
     """
     login = fields.Str(
-        validate=validate.And(validate.Length(min=1, max=128), lambda v: not str.isdigit(v)), required=True
+        validate=validate.And(validate.Length(min=1, max=128), is_not_digits), required=True
     )
     password = fields.Str(validate=validate.Length(min=1), required=True)
 
 
+def fast_load_login(data):
+    """
+    LoginSchema load of well-formed data without the marshmallow machinery,
+    None if the data needs the full validation
+    """
+    if type(data) is not dict or len(data) != 2:
+        return None
+    login = data.get('login')
+    password = data.get('password')
+    if (
+        type(login) is str and type(password) is str
+        and 0 < len(login) <= 128 and password and is_not_digits(login)
+    ):
+        return {'login': login, 'password': password}
+    return None
+
+
 class UserSchema(Schema):
     """
     User response schema
@@ -18,7 +87,7 @@ class UserSchema(Schema):
     id = fields.Int()
     name = fields.Str(validate=validate.Length(min=1, max=32), allow_none=True)
     surname = fields.Str(validate=validate.Length(min=1, max=32), allow_none=True)
-    login = fields.Str(validate=validate.And(validate.Length(min=1, max=128), lambda v: not str.isdigit(v)))
+    login = fields.Str(validate=validate.And(validate.Length(min=1, max=128), is_not_digits))
     password = fields.Str(validate=validate.Length(min=1))
     date_of_birth = fields.Date(allow_none=True)
     permissions = fields.Str(validate=validate.OneOf(('admin', 'read', 'block')))
@@ -27,9 +96,56 @@ class UserSchema(Schema):
         ordered = True
 
 
+class UserFieldsQuerySchema(Schema):
+    """
+    Sparse fieldset of the user response, e.g. fields=id,login
+    """
+    fields = FieldList(UserSchema._declared_fields)
+
+
+class UserFilterSchema(Schema):
+    """
+    User list filter parameters
+    """
+    permissions = fields.Str(validate=validate.OneOf(('admin', 'read', 'block')))
+    date_of_birth_from = fields.Date()
+    date_of_birth_to = fields.Date()
+    login_prefix = fields.Str(validate=validate.Length(min=1, max=128))
+
+
+class UserListQuerySchema(UserFilterSchema, UserFieldsQuerySchema):
+    """
+    User list pagination, filter and fields parameters
+    """
+    limit = fields.Int(validate=validate.Range(min=1, max=1000), load_default=100)
+    cursor = Cursor()
+    sort = fields.Str(validate=validate.OneOf(('id', '-id', 'login', '-login')), load_default='id')
+
+    @validates_schema
+    def validate_cursor(self, data, **kwargs):
+        cursor = data.get('cursor')
+        if cursor is not None and cursor['sort'] != data['sort']:
+            raise ValidationError('Cursor of another sort order', 'cursor')
+
+
+class UserExportQuerySchema(UserFilterSchema):
+    """
+    User export format and filter parameters
+    """
+    format = fields.Str(validate=validate.OneOf(('ndjson', 'csv')), load_default='ndjson')
+
+
 class UserCreateSchema(LoginSchema, UserSchema):
     """
     Create new user schema
     """
     class Meta:
         exclude = ['id']
+
+
+# shared instances, load and dump keep no state in the schema
+login_schema = LoginSchema()
+user_schema = UserSchema()
+user_update_schema = UserSchema(exclude=['id'], partial=True)
+user_create_schema = UserCreateSchema()
+user_create_many_schema = UserCreateSchema(many=True)
@@ -0,0 +1,82 @@
+import json
+
+from aiohttp import web
+from marshmallow import fields
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+from srv.settings.config import CONFIG
+
+
+def _orjson_dumps(data):
+    return orjson.dumps(data)
+
+
+def _json_dumps(data):
+    return json.dumps(data).encode()
+
+
+def get_dumps(library):
+    """
+    JSON encoder to bytes, orjson if it's installed, the stdlib json otherwise
+    """
+    if library == 'orjson' and orjson is not None:
+        return _orjson_dumps
+    return _json_dumps
+
+
+def get_loads(library):
+    """
+    JSON decoder of str or bytes
+    """
+    if library == 'orjson' and orjson is not None:
+        return orjson.loads
+    return json.loads
+
+
+dumps = get_dumps(CONFIG['json'])
+loads = get_loads(CONFIG['json'])
+
+
+def json_response(data=None, *, status=200, headers=None):
+    """
+    web.json_response with the configured encoder, no body if data is None
+    """
+    return web.Response(
+        body=dumps(data) if data is not None else None,
+        status=status, headers=headers, content_type='application/json', charset='utf-8',
+    )
+
+
+# fields dumped as they are for trusted rows
+PLAIN_FIELDS = (fields.Integer, fields.String, fields.Boolean, fields.Float)
+
+
+def compile_serializer(schema, only=None):
+    """
+    Row to dict function equal to schema.dump for trusted database rows,
+    only limits the dumped fields.
+
+    The function is generated once: values of plain fields are taken as they are
+    and dates are formatted, without the per-field dispatch of marshmallow.
+    Other field types are serialized by the schema field
+    """
+    namespace = {'_fields': schema.dump_fields}
+    items = []
+    for name, field in schema.dump_fields.items():
+        if only is not None and name not in only:
+            continue
+        attribute = field.attribute or name
+        value = f'row.{attribute}'
+        if isinstance(field, fields.Date) and field.format in (None, 'iso'):
+            value = f'(None if {value} is None else {value}.isoformat())'
+        elif not isinstance(field, PLAIN_FIELDS):
+            value = f'_fields[{name!r}].serialize({attribute!r}, row)'
+        items.append(f'{field.data_key or name!r}: {value}')
+
+    source = 'def serialize(row):\n    return {' + ', '.join(items) + '}\n'
+    exec(source, namespace)
+    return namespace['serialize']
@@ -1,10 +1,68 @@
+import hashlib
+import functools
+
 from aiohttp import web
+from marshmallow import ValidationError
 from aiohttp_security import remember, forget, check_authorized, check_permission
-from aiohttp_apispec import docs, request_schema, response_schema
+from aiohttp_apispec import docs, request_schema, response_schema, querystring_schema
 
 from srv.actions.authorization import check_credentials
+from srv.store.pg.accessor import AUTOCOMMIT, SNAPSHOT
+
+from .decorators import transaction, fast_validator
+from .formats import FORMATS, CONTENT_TYPES, read_batches
+from .serializers import json_response, compile_serializer
+from .schemas import (
+    UserSchema, UserListQuerySchema, UserExportQuerySchema, UserFieldsQuerySchema, encode_cursor, fast_load_login,
+    login_schema, user_schema, user_update_schema, user_create_schema, user_create_many_schema,
+)
+
+
+# row views of the database are trusted, see compile_serializer
+serialize_user = compile_serializer(user_schema)
+USER_FIELDS = list(user_schema.fields)
+
+
+@functools.lru_cache(maxsize=None)
+def fields_serializer(fields):
+    """
+    Serializer of the sparse fieldset, fields are validated tuples
+    in the schema order, so there are at most 2 ** len(USER_FIELDS) of them
+    """
+    return compile_serializer(user_schema, only=fields)
+
+
+def get_serializer(fields):
+    return serialize_user if fields is None else fields_serializer(fields)
+
 
-from .schemas import LoginSchema, UserSchema, UserCreateSchema
+def digest(value):
+    return hashlib.blake2b(value.encode(), digest_size=8).hexdigest()
+
+
+def row_etag(user_id, version, fields=None):
+    """
+    ETag of the user: the row version and the fieldset
+    """
+    etag = f'{user_id}.{version}'
+    return etag if fields is None else f'{etag}.{digest(",".join(fields))}'
+
+
+def list_etag(version, query_string):
+    """
+    ETag of the list page: the table version and the query parameters
+    """
+    return f'{version}.{digest(query_string)}'
+
+
+def not_modified(request, etag):
+    """
+    304 response if If-None-Match of the request matches the etag, None otherwise
+    """
+    if any(tag.value in (etag, '*') for tag in request.if_none_match or ()):
+        response = web.Response(status=304)
+        response.etag = etag
+        return response
 
 
 @docs(
@@ -17,20 +75,22 @@ from .schemas import LoginSchema, UserSchema, UserCreateSchema
         422: {"description": "Validation error"},
     },
 )
-@request_schema(LoginSchema)
+@request_schema(login_schema)
+@fast_validator(fast_load_login)
+@transaction(AUTOCOMMIT)
 async def login(request):
     """
     User session authorization
     """
-    conn = request.app['conn']
     data = request['data']
-    if not await check_credentials(conn, data):
-        return web.json_response(
+    user = await check_credentials(request.app.db, data, request.app['model']['user'])
+    if user is None:
+        return json_response(
             {'error': 'Invalid username/password combination or this user is blocked'}, status=400
         )
 
-    response = web.json_response(status=200)
-    await remember(request, response, data['login'])
+    response = json_response(status=200)
+    await remember(request, response, data['login'], auth=user)
     return response
 
 
@@ -49,11 +109,58 @@ async def logout(request):
     """
     await check_authorized(request)
 
-    response = web.json_response(status=200)
+    response = json_response(status=200)
     await forget(request, response)
     return response
 
 
+@docs(
+    tags=['Internal'],
+    summary='Database pool telemetry',
+    description='This can only be done by authorized users with admin permissions. '
+                'Pool state of the worker that served the request, acquire wait time histogram in seconds',
+    responses={
+        200: {'description': 'Successful operation'},
+        401: {'description': "You aren't authorized"},
+        403: {'description': "You haven't permissions"},
+        404: {'description': 'The storage has no database pool'},
+    },
+)
+async def pool_telemetry(request):
+    """
+    Database pool telemetry
+    """
+    await check_permission(request, 'admin')
+
+    telemetry = request.app.get('pool_telemetry')
+    if telemetry is None:
+        raise web.HTTPNotFound
+    return json_response(telemetry.snapshot(), status=200)
+
+
+@docs(
+    tags=['Internal'],
+    summary='Prometheus metrics',
+    description='This can only be done by authorized users with admin permissions. '
+                'Metrics of the worker that served the request in the Prometheus text format',
+    responses={
+        200: {'description': 'Successful operation'},
+        401: {'description': "You aren't authorized"},
+        403: {'description': "You haven't permissions"},
+    },
+)
+async def metrics(request):
+    """
+    Prometheus metrics
+    """
+    await check_permission(request, 'admin')
+
+    return web.Response(
+        text=request.app['metrics'].render(),
+        headers={'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'},
+    )
+
+
 class UserView(web.View):
     @docs(
         tags=['User'],
@@ -67,7 +174,7 @@ class UserView(web.View):
             422: {"description": "Validation error"},
         },
     )
-    @request_schema(UserCreateSchema)
+    @request_schema(user_create_schema)
     @response_schema(UserSchema, 201)
     async def post(self):
         """
@@ -75,65 +182,200 @@ class UserView(web.View):
         """
         await check_permission(self.request, 'admin')
 
-        conn = self.request.app['conn']
+        conn = self.request['conn']
         user = self.request.app['model']['user']
 
         user_data = self.request['data']
         created_user = await user.create(conn, user_data)
         if not created_user:
-            return web.json_response({'error': 'Insert error'}, status=400)
+            return json_response({'error': 'Insert error'}, status=400)
 
-        return web.json_response(UserSchema().dump(created_user), status=201)
+        return json_response(serialize_user(created_user), status=201)
 
     @docs(
         tags=['User'],
         summary='Get list of users',
-        description='This can only be done by authorized users',
+        description='This can only be done by authorized users. '
+                    'The next page cursor is returned in the X-Next-Cursor header. '
+                    'The ETag changes with any change of users, If-None-Match with it returns 304. '
+                    'fields limits the returned fields, e.g. fields=id,login',
         responses={
             200: {'description': 'Successful operation, return list of users'},
+            304: {'description': 'Not modified since the If-None-Match ETag'},
             401: {'description': "You aren't authorized"},
+            422: {"description": "Validation error"},
         },
     )
+    @querystring_schema(UserListQuerySchema)
+    @transaction(AUTOCOMMIT)
     async def get(self):
         """
         Get list of users
         """
         await check_authorized(self.request)
 
-        conn = self.request.app['conn']
+        conn = self.request['conn']
+        user = self.request.app['model']['user']
+
+        # the version is read first, so a concurrent write can change the ETag only to a newer one
+        etag = list_etag(await user.table_version(conn), self.request.query_string)
+        response = not_modified(self.request, etag)
+        if response is not None:
+            return response
+
+        params = self.request['querystring']
+        cursor = params.pop('cursor', None)
+        users_list, next_key = await user.read_all(conn, after=cursor and cursor['key'], **params)
+
+        serialize = get_serializer(params.get('fields'))
+        response = json_response([serialize(user_data) for user_data in users_list], status=200)
+        response.etag = etag
+        if next_key is not None:
+            response.headers['X-Next-Cursor'] = encode_cursor(params['sort'], next_key)
+        return response
+
+
+class UserExportView(web.View):
+    @docs(
+        tags=['User'],
+        summary='Export users as NDJSON or CSV',
+        description='This can only be done by authorized users. The response is streamed',
+        responses={
+            200: {'description': 'Successful operation, return stream of users'},
+            401: {'description': "You aren't authorized"},
+            422: {"description": "Validation error"},
+        },
+    )
+    @querystring_schema(UserExportQuerySchema)
+    @transaction(SNAPSHOT)
+    async def get(self):
+        """
+        Export users as NDJSON or CSV
+        """
+        await check_authorized(self.request)
+
+        conn = self.request['conn']
+        user = self.request.app['model']['user']
+
+        params = self.request['querystring']
+        export_format = params.pop('format')
+        serializer = FORMATS[export_format]()
+
+        response = web.StreamResponse(status=200, headers={
+            'Content-Type': serializer.content_type,
+            'Content-Disposition': f'attachment; filename="users.{export_format}"',
+        })
+        await response.prepare(self.request)
+        await response.write(serializer.header(USER_FIELDS))
+        async for rows in user.stream_all(conn, **params):
+            await response.write(serializer.dump(serialize_user(row) for row in rows))
+        await response.write_eof()
+        return response
+
+
+class UserImportView(web.View):
+    @docs(
+        tags=['User'],
+        summary='Bulk import of users from NDJSON or CSV',
+        description='This can only be done by authorized users with admin permissions. '
+                    'Content-Type is application/x-ndjson or text/csv with the header line. '
+                    'Returns the number of created users and errors of rejected lines. '
+                    'Every batch of lines is committed on its own',
+        responses={
+            200: {'description': 'Successful operation, return import report'},
+            401: {'description': "You aren't authorized"},
+            403: {'description': "You haven't permissions"},
+            415: {'description': 'Unsupported content type'},
+        },
+    )
+    @transaction(AUTOCOMMIT)
+    async def post(self):
+        """
+        Bulk import of users from NDJSON or CSV
+        """
+        await check_permission(self.request, 'admin')
+
+        db = self.request.app.db
         user = self.request.app['model']['user']
 
-        users_list = await user.read_all(conn)
-        return web.json_response([UserSchema().dump(user_data) for user_data in users_list], status=200)
+        serializer = CONTENT_TYPES.get(self.request.content_type)
+        if serializer is None:
+            return json_response({'error': 'Unsupported content type'}, status=415)
+
+        batch_size = self.request.app['config']['import_batch_size']
+        created, errors = 0, []
+        async for batch in read_batches(self.request.content, serializer(), batch_size):
+            items = [item for _, item in batch if item is not None]
+            try:
+                loaded, invalid = user_create_many_schema.load(items), {}
+            except ValidationError as err:
+                loaded, invalid = err.valid_data, err.messages
+
+            rows, index = [], 0
+            for line, item in batch:
+                if item is None:
+                    errors.append({'line': line, 'errors': {'_schema': ['Invalid line']}})
+                    continue
+                if index in invalid:
+                    errors.append({'line': line, 'errors': invalid[index]})
+                else:
+                    rows.append((line, loaded[index]))
+                index += 1
+
+            if rows:
+                # hashed before a connection is checked out, the batch is written in a short transaction
+                await user.hash_passwords([data for _, data in rows])
+                async with db.begin() as conn:
+                    batch_created, batch_errors = await user.bulk_create(conn, rows)
+                created += batch_created
+                errors.extend({'line': line, 'errors': error} for line, error in batch_errors)
+
+        errors.sort(key=lambda error: error['line'])
+        return json_response({'created': created, 'errors': errors}, status=200)
 
 
 class UserDetailView(web.View):
     @docs(
         tags=['User'],
         summary='Get user data by id or login',
-        description="This can only be done by authorized users. {slug} may be 'id' or 'login'",
+        description="This can only be done by authorized users. {slug} may be 'id' or 'login'. "
+                    'If-None-Match with the ETag of the user returns 304 while it is unchanged. '
+                    'fields limits the returned fields, e.g. fields=id,login',
         responses={
             200: {'description': 'Successful operation', 'schema': UserSchema},
+            304: {'description': 'Not modified since the If-None-Match ETag'},
             401: {'description': "You aren't authorized"},
             404: {'description': 'Not found'},
+            422: {"description": "Validation error"},
         },
     )
+    @querystring_schema(UserFieldsQuerySchema)
     @response_schema(UserSchema)
+    @transaction(AUTOCOMMIT)
     async def get(self):
         """
         Get user data by id or login
         """
         await check_authorized(self.request)
 
-        conn = self.request.app['conn']
+        conn = self.request['conn']
         user = self.request.app['model']['user']
 
         slug = self.request.match_info['slug']
-        user_data = await user.read(conn, slug)
+        fields = self.request['querystring'].get('fields')
+        if self.request.if_none_match:
+            version = await user.read_version(conn, slug)
+            response = not_modified(self.request, row_etag(*version, fields)) if version else None
+            if response is not None:
+                return response
+
+        user_data = await user.read(conn, slug, fields)
         if not user_data:
             raise web.HTTPNotFound
 
-        return web.json_response(UserSchema().dump(user_data), status=200)
+        response = json_response(get_serializer(fields)(user_data), status=200)
+        response.etag = row_etag(user_data.id, user_data.version, fields)
+        return response
 
     @docs(
         tags=['User'],
@@ -147,7 +389,7 @@ class UserDetailView(web.View):
             422: {"description": "Validation error"},
         },
     )
-    @request_schema(UserSchema(exclude=['id'], partial=True))
+    @request_schema(user_update_schema)
     @response_schema(UserSchema)
     async def patch(self):
         """
@@ -155,16 +397,16 @@ class UserDetailView(web.View):
         """
         await check_permission(self.request, 'admin')
 
-        conn = self.request.app['conn']
+        conn = self.request['conn']
         user = self.request.app['model']['user']
 
         slug = self.request.match_info['slug']
         user_data = self.request['data']
         updated_user = await user.update(conn, slug, user_data)
         if not updated_user:
-            return web.json_response({'error': 'Update error'}, status=400)
+            return json_response({'error': 'Update error'}, status=400)
 
-        return web.json_response(UserSchema().dump(updated_user), status=200)
+        return json_response(serialize_user(updated_user), status=200)
 
     @docs(
         tags=['User'],
@@ -183,11 +425,11 @@ class UserDetailView(web.View):
         """
         await check_permission(self.request, 'admin')
 
-        conn = self.request.app['conn']
+        conn = self.request['conn']
         user = self.request.app['model']['user']
 
         slug = self.request.match_info['slug']
         if not await user.delete(conn, slug):
-            return web.json_response({'error': 'Delete error'}, status=400)
+            return json_response({'error': 'Delete error'}, status=400)
 
-        return web.json_response(status=200)
+        return json_response(status=200)
@@ -1,24 +1,47 @@
 import pytest_asyncio
+import sqlalchemy as sa
 
 from aiohttp.web import HTTPForbidden
 
 from srv.settings.app import create_app
-from tests.fixtures import alembic_engine, alembic_config, alembic_upgrade_downgrade, create_def_data
+from srv.settings.config import CONFIG
+from srv.store.pg.models import user, permissions
+from tests.fixtures import alembic_engine, alembic_config, test_database
 
 
 class Client:
+    """
+    Test client with the connection of the app, everything done with it
+    is rolled back after the test
+    """
+
     def __init__(self, _client, _engine):
         self.client = _client
         self.engine = _engine
 
     async def __aenter__(self):
         self.conn = await self.engine.connect()
+        await self.conn.begin()
+        await reset_sequences(self.conn)
         self.client.conn = self.conn
         return self.client
 
     async def __aexit__(self, exc_type, exc_val, exc_tb):
         await self.conn.rollback()
         await self.conn.close()
+        await self.engine.dispose()
+
+
+async def reset_sequences(conn):
+    """
+    Sequences aren't rolled back, restarting them after the committed rows
+    """
+    for table in (user, permissions):
+        await conn.execute(sa.select(sa.func.setval(
+            sa.func.pg_get_serial_sequence(f'"{table.name}"', 'id'),
+            sa.func.coalesce(sa.func.max(table.c.id), 0) + 1,
+            False,
+        )))
 
 
 @pytest_asyncio.fixture(scope='function', autouse=True)
@@ -35,6 +58,16 @@ async def client(aiohttp_client, mocker, alembic_engine):
     await http_client.close()
 
 
+@pytest_asyncio.fixture(scope='function')
+async def memory_client(aiohttp_client, monkeypatch):
+    """
+    Unauthorized client of the app with the in-memory storage
+    """
+    monkeypatch.setitem(CONFIG, 'storage', 'memory')
+    app = await create_app()
+    return await aiohttp_client(app)
+
+
 @pytest_asyncio.fixture(scope='function')
 async def auth_admin(mocker):
     """
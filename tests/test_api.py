@@ -1,11 +1,35 @@
+import io
+import csv
+import json
 import pytest
+import sqlalchemy as sa
+import queue
+import asyncio
+import logging
+
+from aiohttp import web
+from aiohttp.test_utils import make_mocked_request
+from concurrent.futures import ProcessPoolExecutor
 
 from tests.tools import (
     insert_user, insert_random_user, filing_db_table_user, random_text, random_date, random_permissions,
-    validate_user_initial_data, validate_user_db_data, check_deletion,
+    validate_user_initial_data, validate_user_db_data, check_deletion, get_user_by_login, assert_max_queries,
 )
-from tests.fixtures import alembic_engine, alembic_config, alembic_upgrade_downgrade, create_def_data
-from tests.clients import client, auth_admin, auth_read
+from srv.store.pg.accessor import PostgresAccessor, PGConnect, AUTOCOMMIT, READ_WRITE
+from srv.store.pg.models import user, permissions, session, table_version
+from srv.store.pg.instrumentation import SQLInstrumentation, track_queries
+from srv.actions.cache import TTLCache
+from srv.actions.hashing import PasswordHasher, HasherOverloaded, hash_password
+from srv.web.schemas import UserSchema, LoginSchema, fast_load_login, login_schema
+from srv.web.serializers import compile_serializer, get_dumps
+from srv.store.memory.managers import UserRow
+from srv.settings.config import CONFIG
+from srv.settings.app import create_app
+from srv.generate_users import generate_users
+from srv.settings.log import AccessLogger, DroppingQueueHandler, LogFormatter
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+from tests.fixtures import alembic_engine, alembic_config, test_database
+from tests.clients import client, memory_client, auth_admin, auth_read
 
 
 pytestmark = pytest.mark.asyncio
@@ -22,6 +46,35 @@ async def test_login_with_admin(client):
     assert resp.status == 200
 
 
+async def test_login_validation_fast_path(client, mocker):
+    """
+    Well-formed login data should skip the schema, the rest should be validated by it
+    """
+    load = mocker.spy(login_schema, 'load')
+    resp = await client.post('/login', json={'login': 'admin', 'password': 'admin'})
+    assert resp.status == 200
+    assert not load.called
+
+    resp = await client.post('/login', json={'login': '123', 'password': 'admin'})
+    assert resp.status == 422
+    assert load.called
+
+    for data in (
+        {'login': 'admin', 'password': 'admin'},
+        {'login': 'admin', 'password': ''},
+        {'login': 'a' * 129, 'password': 'admin'},
+        {'login': 1, 'password': 'admin'},
+        {'login': 'admin', 'password': 'admin', 'extra': 1},
+        {'login': 'admin'},
+        ['admin', 'admin'],
+    ):
+        loaded = fast_load_login(data)
+        if loaded is not None:
+            assert loaded == LoginSchema().load(data)
+        else:
+            assert LoginSchema().validate(data)
+
+
 async def test_login_with_invalid_data_1(client):
     """
     Authorization with invalid data should fail 422
@@ -83,6 +136,61 @@ async def test_login_with_block_permissions(client):
     assert returned_data == {'error': 'Invalid username/password combination or this user is blocked'}
 
 
+async def test_login_hashing_off_the_loop(client):
+    """
+    Password verification should run in the hashing executor
+    """
+    hasher = client.app['hasher']
+    assert isinstance(hasher.executor, ProcessPoolExecutor)
+
+    resp = await client.post('/login', json={
+        'login': 'admin',
+        'password': 'admin',
+    })
+    assert resp.status == 200
+    assert hasher.stats()['calls'] == 1
+    assert hasher.stats()['pending'] == 0
+
+
+async def test_hasher_queue_overflow(client, mocker):
+    """
+    Calls over the hasher queue should be rejected with 503, bulk hashing shouldn't be limited
+    """
+    hasher = PasswordHasher('thread', max_workers=1, max_concurrency=1, max_queue=1)
+    await hasher.start()
+    try:
+        tasks = [asyncio.create_task(hasher.hash('secret')) for _ in range(2)]
+        await asyncio.sleep(0)
+        assert hasher.waiting == 1
+        with pytest.raises(HasherOverloaded):
+            await hasher.verify('secret', 'hash')
+        assert len(await hasher.hash_many(['secret'] * 3)) == 3
+        await asyncio.gather(*tasks)
+    finally:
+        await hasher.stop()
+    assert hasher.stats()['rejected'] == 1
+    assert hasher.stats()['waiting'] == 0
+
+    # bulk hashing has its own slots and doesn't fill the queue of interactive calls
+    hasher = PasswordHasher('thread', max_workers=2, max_concurrency=2, max_queue=2, max_bulk_concurrency=1)
+    await hasher.start()
+    try:
+        hashed = hash_password('secret')
+        bulk = asyncio.create_task(hasher.hash_many(['secret'] * 5))
+        await asyncio.sleep(0.01)
+        assert hasher.stats()['bulk_waiting'] == 4
+        assert await hasher.verify('secret', hashed)
+        assert not bulk.done()
+        assert len(await bulk) == 5
+    finally:
+        await hasher.stop()
+    assert hasher.stats()['rejected'] == 0
+
+    mocker.patch.object(client.app['hasher'], 'verify', side_effect=HasherOverloaded)
+    resp = await client.post('/login', json={'login': 'admin', 'password': 'admin'})
+    assert resp.status == 503
+
+
 async def test_logout_with_admin(client, auth_admin):
     """
     Authorized user logout should be successful
@@ -99,6 +207,244 @@ async def test_logout_without_login(client):
     assert resp.status == 401
 
 
+async def test_server_side_session(client):
+    """
+    The session cookie should be an opaque key of the session row,
+    revoked and terminated sessions should be deleted
+    """
+    storage = client.app['session_storage']
+
+    async def login():
+        resp = await client.post('/login', json={'login': 'admin', 'password': 'admin'})
+        assert resp.status == 200
+        return resp.cookies[storage.cookie_name].value
+
+    key = await login()
+    data = await client.conn.scalar(sa.select(session.c.data).where(session.c.key == key))
+    assert data['session']['AIOHTTP_SECURITY'] == 'admin'
+    assert 'admin' not in key
+
+    resp = await client.get('/user')
+    assert resp.status == 200
+
+    assert await storage.revoke('admin') == 1
+    resp = await client.get('/user')
+    assert resp.status == 401
+
+    key = await login()
+    resp = await client.post('/logout')
+    assert resp.status == 200
+    assert await client.conn.scalar(sa.select(sa.func.count()).where(session.c.key == key)) == 0
+    resp = await client.get('/user')
+    assert resp.status == 401
+
+
+async def test_concurrent_logins(aiohttp_client, mocker, monkeypatch):
+    """
+    A login should hold at most one pool connection at once,
+    concurrent logins on a pool of one connection shouldn't time out
+    """
+    # the app works with its own connections, the sessions are committed
+    mocker.stopall()
+    monkeypatch.setitem(CONFIG, 'db_pool', {**CONFIG['db_pool'], 'pool_size': 1, 'max_overflow': 0, 'pool_timeout': 5})
+    app = await create_app()
+    http_client = await aiohttp_client(app)
+    try:
+        responses = await asyncio.gather(*(
+            http_client.post('/login', json={'login': 'admin', 'password': 'admin'}) for _ in range(5)
+        ))
+        assert [resp.status for resp in responses] == [200] * 5
+    finally:
+        await app['session_storage'].revoke('admin')
+        await http_client.close()
+
+
+async def test_session_key_rotation(client):
+    """
+    Login should start a session with a new key and delete the previous one,
+    the key of the client before the login shouldn't get its permissions
+    """
+    storage = client.app['session_storage']
+    user_data = {
+        'login': random_text(),
+        'password': random_text(),
+        'permissions': 'read',
+    }
+    await insert_user(client.conn, user_data)
+    resp = await client.post('/login', json=user_data)
+    assert resp.status == 200
+    key = resp.cookies[storage.cookie_name].value
+
+    resp = await client.post('/login', json={'login': 'admin', 'password': 'admin'})
+    assert resp.status == 200
+    new_key = resp.cookies[storage.cookie_name].value
+    assert new_key != key
+    assert await client.conn.scalar(sa.select(sa.func.count()).where(session.c.key == key)) == 0
+
+    client.session.cookie_jar.clear()
+    client.session.cookie_jar.update_cookies({storage.cookie_name: key})
+    resp = await client.delete(f'/user/{user_data["login"]}')
+    assert resp.status == 401
+
+    client.session.cookie_jar.update_cookies({storage.cookie_name: new_key})
+    resp = await client.get('/user')
+    assert resp.status == 200
+
+
+async def test_unauthorized_request_without_db_connection(client, mocker):
+    """
+    Requests that never reach the database shouldn't check out a connection
+    """
+    connect = mocker.patch('srv.store.pg.accessor.PGConnect.__aenter__', return_value=client.conn)
+
+    resp = await client.post('/logout')
+    assert resp.status == 401
+
+    resp = await client.get('/user')
+    assert resp.status == 401
+    assert connect.call_count == 0
+
+
+async def test_authorization_identity_cache(client):
+    """
+    Repeated authorization checks should be served from the identity cache
+    """
+    resp = await client.post('/login', json={'login': 'admin', 'password': 'admin'})
+    assert resp.status == 200
+
+    cache = client.app['auth_cache']
+    for _ in range(3):
+        resp = await client.get('/user')
+        assert resp.status == 200
+    assert cache.misses == 1
+    assert cache.hits == 2
+
+
+async def test_authorization_cache_invalidation(client):
+    """
+    Blocking an authorized user should revoke access immediately
+    """
+    user_data = {
+        'login': random_text(),
+        'password': random_text(),
+        'permissions': 'read',
+    }
+    await insert_user(client.conn, user_data)
+    resp = await client.post('/login', json=user_data)
+    assert resp.status == 200
+
+    resp = await client.get('/user')
+    assert resp.status == 200
+
+    await client.app['model']['user'].update(client.conn, user_data['login'], {'permissions': 'block'})
+    resp = await client.get('/user')
+    assert resp.status == 401
+
+
+async def test_authorization_cache_other_workers(client, aiohttp_client, alembic_engine, mocker):
+    """
+    Blocking a user in one worker should revoke the access in the other workers
+    without waiting for their cache ttl
+    """
+    # the app works with its own connections, the changes are committed
+    mocker.stopall()
+    user_data = {
+        'login': random_text(),
+        'password': random_text(),
+        'permissions': 'read',
+    }
+    async with alembic_engine.begin() as conn:
+        await insert_user(conn, dict(user_data))
+    # another worker process
+    app = await create_app()
+    worker = await aiohttp_client(app)
+    try:
+        resp = await worker.post('/login', json=user_data)
+        assert resp.status == 200
+        resp = await worker.get('/user')
+        assert resp.status == 200
+
+        async with client.app.db.begin() as conn:
+            await client.app['model']['user'].update(conn, user_data['login'], {'permissions': 'block'})
+        for _ in range(50):
+            resp = await worker.get('/user')
+            if resp.status == 401:
+                break
+            await asyncio.sleep(0.02)
+        assert resp.status == 401
+    finally:
+        await app['session_storage'].revoke(user_data['login'])
+        await worker.close()
+        async with alembic_engine.begin() as conn:
+            await conn.execute(user.delete().where(user.c.login == user_data['login']))
+        await alembic_engine.dispose()
+
+
+async def test_authorization_cache_after_commit(client, alembic_engine, mocker):
+    """
+    Authorization checks between the update and its commit read the old row,
+    it shouldn't stay cached after the commit
+    """
+    # the app works with its own connections, the changes are committed
+    mocker.stopall()
+    user_data = {
+        'login': random_text(),
+        'password': random_text(),
+        'permissions': 'read',
+    }
+    async with alembic_engine.begin() as conn:
+        await insert_user(conn, dict(user_data))
+    try:
+        resp = await client.post('/login', json=user_data)
+        assert resp.status == 200
+
+        async with client.app.db.begin() as conn:
+            await client.app['model']['user'].update(conn, user_data['login'], {'permissions': 'block'})
+            resp = await client.get('/user')
+            assert resp.status == 200
+
+        resp = await client.get('/user')
+        assert resp.status == 401
+    finally:
+        async with alembic_engine.begin() as conn:
+            await conn.execute(user.delete().where(user.c.login == user_data['login']))
+        await alembic_engine.dispose()
+
+
+async def test_session_auth_version(client):
+    """
+    The session should carry the permission until it changes,
+    other updates shouldn't end the session
+    """
+    users = client.app['model']['user']
+    user_data = {
+        'login': random_text(),
+        'password': random_text(),
+        'permissions': 'read',
+    }
+    await insert_user(client.conn, user_data)
+    resp = await client.post('/login', json=user_data)
+    assert resp.status == 200
+
+    await users.update(client.conn, user_data['login'], {'name': random_text(), 'permissions': 'read'})
+    resp = await client.delete('/user/admin')
+    assert resp.status == 403
+    resp = await client.get('/user')
+    assert resp.status == 200
+    user_id, version = await users.get_auth_version(client.conn, user_data['login'])
+    assert version == 0
+
+    await users.update(client.conn, user_data['login'], {'permissions': 'admin'})
+    assert await users.get_auth_version(client.conn, user_data['login']) == (user_id, 1)
+    resp = await client.get('/user')
+    assert resp.status == 401
+
+    resp = await client.post('/login', json=user_data)
+    assert resp.status == 200
+    resp = await client.get('/user/admin')
+    assert resp.status == 200
+
+
 async def test_create_user_with_admin(client, auth_admin):
     """
     Creating user with administrator should be successful
@@ -119,6 +465,50 @@ async def test_create_user_with_admin(client, auth_admin):
     await validate_user_db_data(client.conn, returned_data)
 
 
+async def test_permissions_registry_notification(client, alembic_engine):
+    """
+    Changes of the permissions table should be delivered to the registry
+    """
+    registry = client.app['permissions']
+    await registry.reload()
+    assert registry.by_name == {'block': 1, 'admin': 2, 'read': 3}
+    assert registry.by_id[2] == 'admin'
+
+    try:
+        async with alembic_engine.begin() as conn:
+            await conn.execute(permissions.insert(), {'id': 4, 'perm_name': 'audit'})
+        for _ in range(50):
+            if 'audit' in registry.by_name:
+                break
+            await asyncio.sleep(0.02)
+        assert registry.by_name['audit'] == 4
+    finally:
+        async with alembic_engine.begin() as conn:
+            await conn.execute(permissions.delete().where(permissions.c.id == 4))
+        await alembic_engine.dispose()
+
+
+async def test_create_many_users(client):
+    """
+    Batched create should return row views of all created users
+    """
+    users = [
+        {'login': random_text(6) + str(i), 'password': random_text(), 'permissions': random_permissions()}
+        for i in range(3)
+    ]
+    # optional fields omitted by the schema in some rows
+    users[0].update(name=random_text())
+    users[2].update(surname=random_text())
+    manager = client.app['model']['user']
+    created_users = await manager.create_many(client.conn, [dict(user_data) for user_data in users])
+    assert len(created_users) == 3
+
+    for user_data, created_user in zip(users, created_users):
+        returned_data = UserSchema().dump(created_user)
+        await validate_user_initial_data(user_data, returned_data)
+        await validate_user_db_data(client.conn, returned_data)
+
+
 async def test_create_user_without_login(client):
     """
     Creating user with unauthorized should fail 401
@@ -234,6 +624,214 @@ async def test_read_user_list_with_read_permissions(client, auth_read):
         await validate_user_db_data(client.conn, user)
 
 
+async def test_read_user_list_pagination(client, auth_admin):
+    """
+    Reading user list page by page should return every user once, in order
+    """
+    await filing_db_table_user(client.conn)
+
+    for sort in ('id', '-login'):
+        logins, params = [], {'limit': 2, 'sort': sort}
+        while True:
+            resp = await client.get('/user', params=params)
+            assert resp.status == 200
+            page = await resp.json()
+            assert len(page) <= 2
+            logins.extend(user['login'] for user in page)
+            if 'X-Next-Cursor' not in resp.headers:
+                break
+            params['cursor'] = resp.headers['X-Next-Cursor']
+
+        assert len(logins) == 6  # with default admin
+        if sort == '-login':
+            assert logins == sorted(logins, reverse=True)
+
+
+async def test_read_user_list_with_filters(client, auth_admin):
+    """
+    Reading user list with filters should return only matching users
+    """
+    await filing_db_table_user(client.conn)
+    user_data = await insert_random_user(client.conn)
+
+    resp = await client.get('/user', params={
+        'login_prefix': user_data['login'],
+        'permissions': user_data['permissions'],
+        'date_of_birth_from': user_data['date_of_birth'],
+        'date_of_birth_to': user_data['date_of_birth'],
+    })
+    assert resp.status == 200
+
+    returned_data = await resp.json()
+    assert user_data in returned_data
+    for user in returned_data:
+        assert user['login'].startswith(user_data['login'])
+        assert user['permissions'] == user_data['permissions']
+        assert user['date_of_birth'] == user_data['date_of_birth']
+
+
+async def test_read_user_list_with_invalid_cursor(client, auth_admin):
+    """
+    Reading user list with invalid cursor should fail 422
+    """
+    resp = await client.get('/user', params={'cursor': 'invalid'})
+    assert resp.status == 422
+
+    await filing_db_table_user(client.conn)
+    resp = await client.get('/user', params={'limit': 1, 'sort': 'login'})
+    resp = await client.get('/user', params={'cursor': resp.headers['X-Next-Cursor'], 'sort': 'id'})
+    assert resp.status == 422
+
+
+async def test_export_users_ndjson(client, auth_admin):
+    """
+    Exporting users as NDJSON should stream every user
+    """
+    await filing_db_table_user(client.conn)
+
+    resp = await client.get('/export/user')
+    assert resp.status == 200
+    assert resp.content_type == 'application/x-ndjson'
+
+    lines = (await resp.text()).splitlines()
+    assert len(lines) == 6  # with default admin
+    for line in lines:
+        await validate_user_db_data(client.conn, json.loads(line))
+
+
+async def test_export_users_csv(client, auth_admin):
+    """
+    Exporting users as CSV should stream the header and every matching user
+    """
+    await filing_db_table_user(client.conn)
+
+    resp = await client.get('/export/user', params={'format': 'csv', 'permissions': 'admin'})
+    assert resp.status == 200
+    assert resp.content_type == 'text/csv'
+
+    rows = list(csv.DictReader(io.StringIO(await resp.text())))
+    assert list(rows[0]) == ['id', 'name', 'surname', 'login', 'password', 'date_of_birth', 'permissions']
+    assert 'admin' in [row['login'] for row in rows]
+    assert all(row['permissions'] == 'admin' for row in rows)
+
+
+async def test_export_users_without_login(client):
+    """
+    Exporting users with unauthorized should fail 401
+    """
+    resp = await client.get('/export/user')
+    assert resp.status == 401
+
+
+async def test_import_users_ndjson(client, auth_admin):
+    """
+    Bulk import should create valid users and report rejected lines
+    """
+    existing_user = await insert_random_user(client.conn)
+    users = [
+        {'login': random_text(6) + str(i), 'password': random_text(), 'permissions': random_permissions()}
+        for i in range(3)
+    ]
+    lines = [json.dumps(user_data) for user_data in users] + [
+        json.dumps({'login': '123', 'password': random_text()}),  # invalid login field
+        json.dumps({'login': existing_user['login'], 'password': random_text()}),  # existing login
+        json.dumps(users[0]),  # repeating login
+        'not a json',
+    ]
+
+    resp = await client.post(
+        '/import/user', data='\n'.join(lines), headers={'Content-Type': 'application/x-ndjson'}
+    )
+    assert resp.status == 200
+
+    returned_data = await resp.json()
+    assert returned_data['created'] == 3
+    assert [error['line'] for error in returned_data['errors']] == [4, 5, 6, 7]
+    for user_data in users:
+        db_user_data = await get_user_by_login(client.conn, user_data['login'])
+        await validate_user_initial_data(user_data, db_user_data)
+
+
+async def test_import_users_batches(client, auth_admin, mocker, monkeypatch):
+    """
+    Every import batch should be hashed without a connection and written in its own transaction
+    """
+    monkeypatch.setitem(client.app['config'], 'import_batch_size', 2)
+    hasher = client.app['hasher']
+    hash_many = hasher.hash_many
+    held = []
+
+    async def hash_batch(passwords):
+        held.append(PGConnect.__aenter__.call_count - PGConnect.__aexit__.call_count)
+        return await hash_many(passwords)
+
+    mocker.patch.object(hasher, 'hash_many', side_effect=hash_batch)
+    lines = [json.dumps({'login': random_text(6) + str(i), 'password': random_text()}) for i in range(5)]
+
+    resp = await client.post(
+        '/import/user', data='\n'.join(lines), headers={'Content-Type': 'application/x-ndjson'}
+    )
+    assert resp.status == 200
+    assert (await resp.json())['created'] == 5
+    assert held == [0, 0, 0]
+    assert PGConnect.__aenter__.call_count == 3
+
+
+async def test_import_users_csv(client, auth_admin):
+    """
+    Bulk import from CSV should create users with optional fields omitted
+    """
+    users = [
+        {'login': random_text(6) + str(i), 'password': random_text(), 'date_of_birth': random_date()}
+        for i in range(2)
+    ]
+    body = 'name,login,password,date_of_birth\n' + ''.join(
+        f',{user_data["login"]},{user_data["password"]},{user_data["date_of_birth"]}\n' for user_data in users
+    )
+
+    resp = await client.post('/import/user', data=body, headers={'Content-Type': 'text/csv'})
+    assert resp.status == 200
+    assert await resp.json() == {'created': 2, 'errors': []}
+    for user_data in users:
+        db_user_data = await get_user_by_login(client.conn, user_data['login'])
+        await validate_user_initial_data(user_data, db_user_data)
+        assert db_user_data['name'] is None
+        assert db_user_data['permissions'] == 'read'
+
+
+async def test_import_users_with_read_permissions(client, auth_read):
+    """
+    Bulk import with a user with read permissions should fail 403
+    """
+    resp = await client.post('/import/user', data='', headers={'Content-Type': 'text/csv'})
+    assert resp.status == 403
+
+
+async def test_read_user_list_without_transaction(client, auth_admin, mocker):
+    """
+    Reading user list should use an autocommit connection without BEGIN/COMMIT
+    """
+    transaction = mocker.spy(PostgresAccessor, 'transaction')
+    begin = mocker.spy(PostgresAccessor, 'begin')
+
+    resp = await client.get('/user')
+    assert resp.status == 200
+    assert transaction.call_args.args[1] == AUTOCOMMIT
+    assert begin.call_count == 0
+
+
+async def test_update_user_with_transaction(client, auth_admin, mocker):
+    """
+    Updating user should use a read-write transaction
+    """
+    user_data = await insert_random_user(client.conn)
+    transaction = mocker.spy(PostgresAccessor, 'transaction')
+
+    resp = await client.patch(f'/user/{user_data["id"]}', json={'name': random_text()})
+    assert resp.status == 200
+    assert transaction.call_args.args[1] == READ_WRITE
+
+
 async def test_read_user_with_admin_by_login(client, auth_admin):
     """
     Reading user by login with administrator should be successful
@@ -264,6 +862,206 @@ async def test_read_user_with_admin_by_id(client, auth_admin):
     await validate_user_db_data(client.conn, returned_data)
 
 
+async def test_read_user_coalescing(client, auth_admin, mocker):
+    """
+    Concurrent reads of a user should share one query,
+    cached rows should be invalidated by update and delete
+    """
+    users = client.app['model']['user']
+    user_data = await insert_random_user(client.conn)
+    login = user_data['login']
+
+    rows = await asyncio.gather(*(users.read(client.conn, login) for _ in range(5)))
+    assert all(row == rows[0] for row in rows)
+    assert users.read_stats() == {'calls': 1, 'coalesced': 4}
+
+    mocker.patch.object(users, 'read_cache', TTLCache(ttl=60))
+    resp = await client.get(f'/user/{user_data["id"]}')
+    assert resp.status == 200
+    with assert_max_queries(client.conn, 0):
+        resp = await client.get(f'/user/{user_data["id"]}')
+    assert resp.status == 200
+    assert users.read_stats()['cache_hits'] == 1
+
+    resp = await client.patch(f'/user/{login}', json={'name': 'renamed', 'permissions': 'read'})
+    assert resp.status == 200
+    resp = await client.get(f'/user/{user_data["id"]}')
+    assert (await resp.json())['name'] == 'renamed'
+
+    resp = await client.delete(f'/user/{login}')
+    assert resp.status == 200
+    resp = await client.get(f'/user/{user_data["id"]}')
+    assert resp.status == 404
+
+    resp = await client.get('/metrics')
+    assert 'user_read_coalesced_total 4' in await resp.text()
+
+
+async def test_read_user_cache_after_commit(client, alembic_engine, mocker):
+    """
+    Reads between the update and its commit return the old row,
+    it shouldn't stay cached after the commit
+    """
+    # the app works with its own connections, the changes are committed
+    mocker.stopall()
+    users = client.app['model']['user']
+    mocker.patch.object(users, 'read_cache', TTLCache(ttl=60))
+    user_data = {
+        'login': random_text(),
+        'password': random_text(),
+        'name': 'initial',
+    }
+    async with alembic_engine.begin() as conn:
+        await insert_user(conn, dict(user_data))
+    try:
+        resp = await client.post('/login', json={'login': 'admin', 'password': 'admin'})
+        assert resp.status == 200
+
+        async with client.app.db.begin() as conn:
+            await users.update(conn, user_data['login'], {'name': 'renamed', 'permissions': 'read'})
+            resp = await client.get(f'/user/{user_data["login"]}')
+            assert (await resp.json())['name'] == 'initial'
+
+        resp = await client.get(f'/user/{user_data["login"]}')
+        assert (await resp.json())['name'] == 'renamed'
+    finally:
+        async with alembic_engine.begin() as conn:
+            await conn.execute(user.delete().where(user.c.login == user_data['login']))
+        await alembic_engine.dispose()
+
+
+async def test_read_user_conditional(client, auth_admin):
+    """
+    Requests with the ETag of an unchanged user or list should return 304 with one query
+    """
+    user_data = await insert_random_user(client.conn)
+
+    resp = await client.get(f'/user/{user_data["login"]}')
+    assert resp.status == 200
+    etag = resp.headers['ETag']
+    xmin = await client.conn.scalar(sa.select(sa.literal_column('xmin')).where(user.c.id == user_data['id']))
+    assert etag == f'"{user_data["id"]}.{xmin}"'
+    with assert_max_queries(client.conn, 1):
+        resp = await client.get(f'/user/{user_data["id"]}', headers={'If-None-Match': etag})
+    assert resp.status == 304
+    assert resp.headers['ETag'] == etag
+    resp = await client.get(f'/user/{user_data["id"]}', headers={'If-None-Match': '"0.0"'})
+    assert resp.status == 200
+
+    resp = await client.get('/user', params={'limit': 10})
+    etag = resp.headers['ETag']
+    with assert_max_queries(client.conn, 1):
+        resp = await client.get('/user', params={'limit': 10}, headers={'If-None-Match': etag})
+    assert resp.status == 304
+    resp = await client.get('/user', params={'limit': 5}, headers={'If-None-Match': etag})
+    assert resp.status == 200
+
+    resp = await client.patch(f'/user/{user_data["id"]}', json={'name': 'renamed', 'permissions': 'read'})
+    assert resp.status == 200
+    # the list version is bumped at commit, the test transaction isn't committed
+    await client.conn.execute(sa.text('SET CONSTRAINTS ALL IMMEDIATE'))
+    resp = await client.get('/user', params={'limit': 10}, headers={'If-None-Match': etag})
+    assert resp.status == 200
+    assert resp.headers['ETag'] != etag
+
+
+async def test_table_version_concurrent_writes(alembic_engine):
+    """
+    The list version should be bumped once per transaction at commit,
+    uncommitted writes shouldn't block the writes of other rows
+    """
+    logins = [random_text() for _ in range(3)]
+    select_version = sa.select(table_version.c.version).where(table_version.c.name == 'user')
+    async with alembic_engine.begin() as conn:
+        await insert_user(conn, {'login': logins[0], 'password': random_text()})
+    try:
+        async with alembic_engine.connect() as conn:
+            version = await conn.scalar(select_version)
+
+        async with alembic_engine.connect() as writer, alembic_engine.connect() as other:
+            await writer.begin()
+            for login in logins[1:]:
+                await insert_user(writer, {'login': login, 'password': random_text()})
+
+            async with other.begin():
+                await other.execute(sa.text("SET LOCAL lock_timeout = '2s'"))
+                await other.execute(user.update().values(name='renamed').where(user.c.login == logins[0]))
+            assert await other.scalar(select_version) == version + 1
+
+            await writer.commit()
+            assert await other.scalar(select_version) == version + 2
+    finally:
+        async with alembic_engine.begin() as conn:
+            await conn.execute(user.delete().where(user.c.login.in_(logins)))
+        await alembic_engine.dispose()
+
+
+async def test_read_user_conditional_memory(memory_client):
+    """
+    Row versions of the in-memory storage should change with every update
+    """
+    resp = await memory_client.post('/login', json={'login': 'admin', 'password': 'admin'})
+    assert resp.status == 200
+
+    resp = await memory_client.get('/user/admin')
+    etag = resp.headers['ETag']
+    resp = await memory_client.get('/user/1', headers={'If-None-Match': etag})
+    assert resp.status == 304
+
+    resp = await memory_client.patch('/user/admin', json={'name': 'renamed', 'permissions': 'admin'})
+    assert resp.status == 200
+    resp = await memory_client.get('/user/admin', headers={'If-None-Match': etag})
+    assert resp.status == 200
+    assert resp.headers['ETag'] != etag
+
+
+async def test_read_user_fields(client, auth_admin):
+    """
+    fields should narrow the response and the select, the permissions join only if they are requested
+    """
+    await filing_db_table_user(client.conn, size=5)
+    user_data = await insert_random_user(client.conn)
+    # users without permissions aren't listed with or without the join
+    orphan = await insert_random_user(client.conn)
+    await client.conn.execute(user.update().where(user.c.id == orphan['id']).values(permissions=None))
+
+    with assert_max_queries(client.conn, 2) as statements:
+        resp = await client.get('/user', params={'fields': 'login,id', 'sort': '-login'})
+    assert resp.status == 200
+    users_list = await resp.json()
+    assert all(list(item) == ['id', 'login'] for item in users_list)
+    assert 'password' not in statements[-1] and 'permissions.perm_name' not in statements[-1]
+
+    assert [item['login'] for item in users_list] == sorted((item['login'] for item in users_list), reverse=True)
+    resp = await client.get('/user')
+    assert {item['id'] for item in await resp.json()} == {item['id'] for item in users_list}
+    assert orphan['id'] not in {item['id'] for item in users_list}
+
+    with assert_max_queries(client.conn, 1) as statements:
+        resp = await client.get(f'/user/{user_data["login"]}', params={'fields': 'permissions'})
+    assert await resp.json() == {'permissions': user_data['permissions']}
+    assert 'permissions.perm_name' in statements[-1]
+    etag = resp.headers['ETag']
+    resp = await client.get(f'/user/{user_data["login"]}')
+    assert resp.headers['ETag'] != etag
+
+    resp = await client.get('/user', params={'fields': 'login,secret'})
+    assert resp.status == 422
+
+
+async def test_read_user_fields_memory(memory_client):
+    """
+    fields should narrow the response of the in-memory storage
+    """
+    resp = await memory_client.post('/login', json={'login': 'admin', 'password': 'admin'})
+    assert resp.status == 200
+
+    resp = await memory_client.get('/user', params={'fields': 'login'})
+    assert await resp.json() == [{'login': 'admin'}]
+    resp = await memory_client.get('/user/admin', params={'fields': 'id,date_of_birth'})
+    assert await resp.json() == {'id': 1, 'date_of_birth': '1970-01-01'}
+
+
 async def test_read_user_without_login(client):
     """
     Reading user with unauthorized should fail 401
@@ -475,6 +1273,291 @@ async def test_delete_user_with_read_permissions(client, auth_read):
     assert resp.status == 403
 
 
+async def test_pool_telemetry(client):
+    """
+    Pool telemetry and metrics should be available only to admins
+    """
+    for path in ('/internal/pool', '/metrics'):
+        resp = await client.get(path)
+        assert resp.status == 401
+
+    resp = await client.post('/login', json={'login': 'admin', 'password': 'admin'})
+    assert resp.status == 200
+    resp = await client.get('/internal/pool')
+    assert resp.status == 200
+
+    returned_data = await resp.json()
+    assert {'size', 'checked_in', 'checked_out', 'overflow', 'timeouts', 'wait_time'} <= set(returned_data)
+    assert returned_data['size'] == client.app['config']['db_pool']['pool_size']
+
+
+async def test_pool_timeout(client, auth_admin, mocker):
+    """
+    Pool timeout should fail 503 and be counted
+    """
+    mocker.patch('srv.store.pg.accessor.PGConnect.__aenter__', side_effect=PoolTimeoutError)
+
+    resp = await client.get('/user')
+    assert resp.status == 503
+
+    telemetry = client.app['pool_telemetry']
+    engine = mocker.Mock(connect=mocker.AsyncMock(side_effect=PoolTimeoutError))
+    with pytest.raises(PoolTimeoutError):
+        await telemetry.connect(engine)
+    assert telemetry.timeouts == 1
+
+
+async def test_metrics(client, auth_admin):
+    """
+    Metrics should count requests by route, method and status
+    """
+    await client.get('/user')
+    await client.get('/user/non_exist')
+    await client.get('/non_exist')
+
+    resp = await client.get('/metrics')
+    assert resp.status == 200
+
+    text = await resp.text()
+    assert 'http_requests_total{route="UserView",method="GET",status="200"} 1' in text
+    assert 'http_requests_total{route="UserDetailView",method="GET",status="404"} 1' in text
+    assert 'http_requests_total{route="unmatched",method="GET",status="404"} 1' in text
+    assert 'http_request_duration_seconds_count{route="UserView",method="GET"} 1' in text
+    assert 'http_request_db_seconds_count{route="UserView",method="GET"} 1' in text
+    assert 'http_request_queries_count{route="UserView",method="GET"} 1' in text
+    assert 'auth_cache_hits_total 0' in text
+    assert 'hasher_queue_wait_seconds_bucket{le="+Inf"} 0' in text
+
+
+async def test_user_endpoints_query_count(client, auth_admin):
+    """
+    User endpoints should execute a constant number of queries
+    """
+    await filing_db_table_user(client.conn, size=20)
+    await client.app['permissions'].reload()
+
+    # the table version of the ETag and the page
+    with assert_max_queries(client.conn, 2):
+        resp = await client.get('/user', params={'limit': 10})
+        assert resp.status == 200
+
+    with assert_max_queries(client.conn, 1):
+        resp = await client.post('/user', json={
+            'name': 'Ivan',
+            'surname': 'Ivanov',
+            'login': 'ivan',
+            'password': 'ivan',
+            'date_of_birth': '2000-01-01',
+            'permissions': 'read',
+        })
+        assert resp.status == 201
+
+    with assert_max_queries(client.conn, 1):
+        resp = await client.get('/user/ivan')
+        assert resp.status == 200
+
+    with assert_max_queries(client.conn, 1):
+        resp = await client.patch('/user/ivan', json={'name': 'Petr', 'permissions': 'admin'})
+        assert resp.status == 200
+
+    with assert_max_queries(client.conn, 1):
+        resp = await client.delete('/user/ivan')
+        assert resp.status == 200
+
+
+async def test_slow_query_log(client, auth_admin, mocker):
+    """
+    Queries should be counted per request, slow ones logged and explained
+    """
+    logger = mocker.patch('srv.store.pg.instrumentation.logger')
+    instrumentation = SQLInstrumentation()
+    instrumentation.setup(client.conn.engine, slow_query_time=0, explain_sample_rate=1)
+    try:
+        resp = await client.get('/user')
+        assert resp.status == 200
+        await asyncio.gather(*instrumentation._tasks)
+    finally:
+        await instrumentation.stop()
+        await client.conn.engine.dispose()
+
+    assert instrumentation.slow_queries >= 1
+    messages = [call.args[0] % call.args[1:] for call in logger.warning.call_args_list]
+    assert any(message.startswith('Slow query (') for message in messages)
+    assert any(message.startswith('Slow query plan:') and 'Buffers' in message for message in messages)
+
+    resp = await client.get('/metrics')
+    text = await resp.text()
+    assert 'http_request_queries_bucket{route="UserView",method="GET",le="1"} 0' in text
+    assert 'http_request_queries_bucket{route="UserView",method="GET",le="2"} 1' in text
+
+
+async def test_failed_query_timing(client):
+    """
+    Failed statements shouldn't leave timing state on the pooled connection
+    """
+    instrumentation = SQLInstrumentation()
+    instrumentation.setup(client.conn.engine)
+    try:
+        with track_queries() as stats:
+            for _ in range(3):
+                with pytest.raises(sa.exc.DBAPIError):
+                    async with client.conn.begin_nested():
+                        await client.conn.execute(sa.text('SELECT 1 / 0'))
+            await client.conn.execute(sa.text('SELECT 1'))
+    finally:
+        await instrumentation.stop()
+    assert 'query_started' not in client.conn.sync_connection.info
+    assert stats.queries >= 1
+    assert stats.db_time < 1
+
+
+async def test_logging_queue_overflow():
+    """
+    Records should be dropped when the logging queue is full, structured ones formatted as JSON
+    """
+    handler = DroppingQueueHandler(queue.Queue(1))
+    record = logging.makeLogRecord({'msg': 'access', 'fields': {'status': 200}})
+    handler.handle(record)
+    handler.handle(record)
+    assert handler.dropped == 1
+
+    line = json.loads(LogFormatter().format(handler.queue.get_nowait()))
+    assert line['message'] == 'access'
+    assert line['status'] == 200
+
+
+async def test_access_log_sampling(mocker):
+    """
+    Access log should skip sampled out successful requests and always log errors
+    """
+    mocker.patch.dict(CONFIG['logging']['access_sample_rates'], {'UserView': 0})
+    logger = mocker.Mock()
+    access_logger = AccessLogger(logger, '')
+
+    request = make_mocked_request('GET', '/user')
+    request['route_name'] = 'UserView'
+    access_logger.log(request, web.Response(status=200), 0.01)
+    assert not logger.info.called
+
+    access_logger.log(request, web.Response(status=500), 0.01)
+    fields = logger.info.call_args.kwargs['extra']['fields']
+    assert fields['route'] == 'UserView'
+    assert fields['status'] == 500
+
+    request = make_mocked_request('GET', '/user/admin')
+    request['route_name'] = 'UserDetailView'
+    access_logger.log(request, web.Response(status=200), 0.01)
+    assert logger.info.call_args.kwargs['extra']['fields']['route'] == 'UserDetailView'
+
+
+async def test_generate_users(client):
+    """
+    Generated users should follow the permission weights and login lengths
+    """
+    inserted = await generate_users(
+        client.conn, 300, batch_size=128, weights={'read': 1, 'block': 0}, login_length=(8, 10), seed=1,
+    )
+    assert inserted == 300
+
+    ret = await client.conn.execute(
+        sa.select(user.c.login, permissions.c.perm_name).join(permissions).where(user.c.login != 'admin')
+    )
+    rows = ret.fetchall()
+    assert len(rows) == 300
+    assert {perm_name for _, perm_name in rows} == {'read'}
+    assert all(8 <= len(login) <= 10 for login, _ in rows)
+
+    await generate_users(client.conn, 10, seed=1)
+    assert await client.conn.scalar(sa.select(sa.func.count()).select_from(user)) == 311
+
+    resp = await client.post('/login', json={'login': rows[0][0], 'password': 'password'})
+    assert resp.status == 200
+
+
+async def test_memory_storage(memory_client):
+    """
+    The in-memory storage should behave as the database for CRUD and authorization
+    """
+    resp = await memory_client.get('/user')
+    assert resp.status == 401
+
+    resp = await memory_client.post('/login', json={'login': 'admin', 'password': 'admin'})
+    assert resp.status == 200
+
+    users = [
+        {'login': f'user{i}', 'password': 'secret', 'date_of_birth': f'200{i}-01-01', 'permissions': perm}
+        for i, perm in enumerate(('read', 'read', 'block'))
+    ]
+    for user_data in users:
+        resp = await memory_client.post('/user', json=user_data)
+        assert resp.status == 201
+    resp = await memory_client.post('/user', json=users[0])
+    assert resp.status == 400
+
+    logins, params = [], {'limit': 2, 'sort': '-login'}
+    while True:
+        resp = await memory_client.get('/user', params=params)
+        logins.extend(user['login'] for user in await resp.json())
+        if 'X-Next-Cursor' not in resp.headers:
+            break
+        params['cursor'] = resp.headers['X-Next-Cursor']
+    assert logins == ['user2', 'user1', 'user0', 'admin']
+
+    resp = await memory_client.get('/user', params={'permissions': 'read', 'date_of_birth_from': '2001-01-01'})
+    assert [user['login'] for user in await resp.json()] == ['user1']
+
+    resp = await memory_client.patch('/user/user0', json={'login': 'user1'})
+    assert resp.status == 400
+    resp = await memory_client.patch('/user/user0', json={'name': 'Ivan', 'permissions': 'admin'})
+    assert resp.status == 200
+    returned_data = await resp.json()
+    assert returned_data['name'] == 'Ivan'
+    assert returned_data['permissions'] == 'admin'
+
+    resp = await memory_client.delete('/user/user1')
+    assert resp.status == 200
+    resp = await memory_client.get('/user/user1')
+    assert resp.status == 404
+
+    resp = await memory_client.post('/login', json={'login': 'user2', 'password': 'secret'})
+    assert resp.status == 400
+    resp = await memory_client.post('/login', json={'login': 'user0', 'password': 'secret'})
+    assert resp.status == 200
+    resp = await memory_client.delete('/user/user2')
+    assert resp.status == 200
+
+    resp = await memory_client.get('/metrics')
+    assert resp.status == 200
+    text = await resp.text()
+    assert 'auth_cache_hits_total' in text
+    assert 'db_pool_' not in text and 'db_slow_queries_total' not in text
+    resp = await memory_client.get('/internal/pool')
+    assert resp.status == 404
+
+
+async def test_compiled_serializer_parity(client):
+    """
+    Compiled row serializer and encoders should give the same output as marshmallow and json
+    """
+    await filing_db_table_user(client.conn)
+    await insert_user(client.conn, {'login': 'empty', 'password': 'empty', 'name': None, 'date_of_birth': None})
+    rows, _ = await client.app['model']['user'].read_all(client.conn)
+    rows.append(UserRow(1, None, 'Ivanov', 'ivan', 'hash', None, 'read'))
+
+    for schema in (UserSchema(), UserSchema(only=['login', 'date_of_birth'])):
+        serialize = compile_serializer(schema)
+        expected = schema.dump(rows, many=True)
+        serialized = [serialize(row) for row in rows]
+        assert serialized == expected
+        assert [list(item) for item in serialized] == [list(item) for item in expected]
+
+    serialize = compile_serializer(UserSchema(), only=('id', 'date_of_birth'))
+    assert [serialize(row) for row in rows] == UserSchema(only=['id', 'date_of_birth']).dump(rows, many=True)
+
+    for library in ('orjson', 'json'):
+        assert json.loads(get_dumps(library)(expected)) == expected
+
+
 async def test_api_documentation(client):
     """
     Api documentation should be available by url from the config['docs_url']
@@ -0,0 +1,14 @@
+import pytest
+
+from pytest_alembic.tests import test_single_head_revision, test_up_down_consistency
+from sqlalchemy.ext.asyncio import create_async_engine
+
+from tests.fixtures import alembic_config, scratch_database
+
+
+@pytest.fixture
+def alembic_engine(scratch_database):
+    """
+    Engine of the scratch database, the migrations are run up and down on it
+    """
+    return create_async_engine(scratch_database)
@@ -2,6 +2,8 @@ import string
 import random
 import sqlalchemy as sa
 
+from contextlib import contextmanager
+
 from passlib.hash import sha256_crypt
 from datetime import date, timedelta
 
@@ -131,3 +133,22 @@ def random_permissions():
     Random user permissions
     """
     return random.choice(('admin', 'read', 'block'))
+
+
+@contextmanager
+def assert_max_queries(conn, limit):
+    """
+    Asserting the number of queries executed with the connection in the block.
+    Yields the list of executed statements
+    """
+    statements = []
+
+    def count(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    sa.event.listen(conn.sync_connection, 'before_cursor_execute', count)
+    try:
+        yield statements
+    finally:
+        sa.event.remove(conn.sync_connection, 'before_cursor_execute', count)
+    assert len(statements) <= limit, f'{len(statements)} queries, expected at most {limit}:\n' + '\n'.join(statements)